@@ -1,11 +1,19 @@
+import argparse
+import sys
 from enum import Enum, auto
+from pathlib import Path
 import pygame as pg
 import vi
 from pygame.math import Vector2
-from vi import Agent, Simulation
+from vi import Agent, HeadlessSimulation, Simulation
 from vi.config import Config, dataclass, deserialize
+from typing import Optional
 import numpy as np
 from numpy import random as r
+import polars as pl
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Common.neighbours import use_neighbour_index
 
 
 @deserialize
@@ -14,7 +22,7 @@ class AggregationConfig(Config):
     a: float = 2.6
     b: float = 2.2
     
-    t: int = 30 + round(r.normal(0,10)) # t = t_join = t_leave
+    t: Optional[int] = None # t = t_join = t_leave, drawn per run from the seed when not given
     d: int = 150 # number of time steps between each p_leave is evaluated
 
     delta_time: float = 1.0
@@ -22,6 +30,14 @@ class AggregationConfig(Config):
     def weights(self) -> tuple[float, float, int, int]:
         return (self.a, self.b, self.t, self.d)
 
+    def draw_join_buffer(self):
+        '''
+        Draws t for this run from the seed, unless it was set explicitly
+        '''
+        if self.t is None:
+            self.t = 30 + round(np.random.default_rng(self.seed).normal(0, 10))
+        return self
+
 
 class Bee(Agent):
     state: int = 0 # 0 -> wandering, 1 -> joining, 2 -> still, 3 -> leaving
@@ -75,7 +91,7 @@ class Bee(Agent):
             self.pos += self.move
 
     def change_position(self):
-        in_proximity = self.in_proximity_accuracy().count()
+        in_proximity = self.shared.neighbours.count(self)
         a, b, t, d= self.config.weights()
         self.there_is_no_escape()
 
@@ -132,17 +148,40 @@ class AggregationLive(Simulation):
                     print('change')
 
         a, b, t, d = self.config.weights()'''
-(
-    Simulation(
-        AggregationConfig(
-            image_rotation=True,
-            movement_speed=1.5,
-            radius=40,
-            seed=2,
-            fps_limit=150,
-        )
-    )
+
+def populate(simulation):
+    simulation.config.draw_join_buffer()
+    return (
+        use_neighbour_index(simulation)
         .spawn_site("bubble-full.png", 375, 375)
         .batch_spawn_agents(50, Bee, images=["green.png"])
-        .run()
-)
+    )
+
+
+def run_simulation(config: AggregationConfig) -> pl.DataFrame:
+    '''
+    Runs the single-site aggregation headless and returns the snapshots of every bee
+    '''
+    return populate(HeadlessSimulation(config)).run().snapshots
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live single-site aggregation")
+    parser.add_argument("--seed", type=int, default=2)
+    args = parser.parse_args()
+
+    populate(
+        Simulation(
+            AggregationConfig(
+                image_rotation=True,
+                movement_speed=1.5,
+                radius=40,
+                seed=args.seed,
+                fps_limit=150,
+            )
+        )
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,77 @@
+import argparse
+import sys
 from enum import Enum, auto
+from pathlib import Path
 import pygame as pg
 import vi
 from pygame.math import Vector2
-from vi import Agent, Simulation
+from vi import Agent, HeadlessSimulation, Simulation
 from vi.config import Config, dataclass, deserialize
+from dataclasses import dataclass as frozen_dataclass, replace
+from typing import Optional
 import numpy as np
-from numpy import random as r
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Common.checkpoint import use_checkpoints
+from Common.control import use_control_channel
+from Common.lean import LeanAgent
+from Common.metrics import use_counting_metrics
+from Common.neighbours import use_neighbour_index
+from Common.parameters import publish_parameters
+from Common.results import ResultStore
+from Common.stopping import Stationary, use_stop_conditions
+from Common.streams import use_random_streams
+from Common.transport import FrameRing, use_frame_ring
 import polars as pl
-import seaborn as sns
 
 
 
+@frozen_dataclass(frozen=True, slots=True)
+class AggregationParameters:
+    '''
+    The settings the bees read every frame, frozen once per run by AggregationConfig.parameters()
+    '''
+    a: float
+    b: float
+    t: int
+    d: int
+    w: int
+    vectorized: bool
+
+
 @deserialize
 @dataclass
 class AggregationConfig(Config):
     a: float = 2.6
     b: float = 2.2
-    t: int = round(r.normal(70,50)) # t = t_join = t_leave
+    t: Optional[int] = None # t = t_join = t_leave, drawn per run from the seed when not given
     d: int = 300 # number of time steps between each p_leave is evaluated
     w: int = 500 # number of time steps it takes to move agent of site if not deciding to join or leaving
 
+    vectorized: bool = False # evaluate the state machine of all bees at once in AggregationSimulation
+    lean: bool = False # spawn LeanBee, slotted state and shared images for large swarms
+
+    stationary_window: Optional[int] = None # end the run once the site occupancy stopped drifting over this many frames
+    stationary_tolerance: float = 1.0 # allowed drift of the mean bees per site between the two halves of the window
+    stop_reason: Optional[str] = None # why the run ended early, set by the stop conditions
+    stop_frame: Optional[int] = None
+
 
-    def weights(self) -> tuple[float, float, int, int, int]:
-        return (self.a, self.b, self.t, self.d, self.w)
+    def parameters(self) -> AggregationParameters:
+        return AggregationParameters(a=self.a, b=self.b, t=self.t, d=self.d, w=self.w, vectorized=self.vectorized)
+
+    def stop_conditions(self) -> list:
+        if self.stationary_window is None:
+            return []
+        return [Stationary(self.stationary_window, self.stationary_tolerance)]
+
+    def draw_join_buffer(self):
+        '''
+        Draws t for this run from the seed, unless it was set explicitly
+        '''
+        if self.t is None:
+            self.t = round(np.random.default_rng(self.seed).normal(70, 50))
+        return self
 
 
 class Bee(Agent):
@@ -30,12 +79,13 @@ class Bee(Agent):
     t_step = 0
     d_step = 0
     w_step = 0
+    moves = 0 # number of moves to make this frame, set by AggregationSimulation when vectorized
 
     config: AggregationConfig
 
     def wandering(self, in_proximity, a, w):
         self.pos += self.move
-        uniform_roll = r.uniform()
+        uniform_roll = self.shared.streams.uniform("bee.join", self.id)
         p_join = 0.03 + 0.48 * (1 - np.exp(-a * in_proximity))
 
 
@@ -72,7 +122,7 @@ class Bee(Agent):
         if self.d_step == d:
             self.d_step = 0
             
-            uniform_roll = r.uniform()
+            uniform_roll = self.shared.streams.uniform("bee.leave", self.id)
             p_leave = np.exp(-b * in_proximity)
         
             if p_leave > uniform_roll:
@@ -89,24 +139,36 @@ class Bee(Agent):
             self.pos += self.move
 
     def change_position(self):
-        in_proximity = self.in_proximity_accuracy().count()
-        a, b, t, d, w = self.config.weights()
+        p = self.shared.parameters
+        if p.vectorized:
+            # the moves one at a time, like the per-bee state machine makes them
+            self.there_is_no_escape()
+            for _ in range(self.moves):
+                self.pos += self.move
+            return
+
+        in_proximity = self.shared.neighbours.count(self)
         self.there_is_no_escape()
 
         if self.state == 0:
-            self.wandering(in_proximity, a, w)
+            self.wandering(in_proximity, p.a, p.w)
         if self.state == 1:
-            self.join(t)
+            self.join(p.t)
         if self.state == 2:
-            self.still(in_proximity, b, d)
+            self.still(in_proximity, p.b, p.d)
         if self.state == 3:
-            self.leave(w)
+            self.leave(p.w)
             
     def update(self):
-        if self.on_site_id() is not None:
-            self.save_data("site_id", self.on_site_id())
-        else:
-            self.save_data("site_id", 2)
+        site_id = self.shared.neighbours.site_id(self)
+        self.save_data("site_id", 2 if site_id is None else site_id)
+
+
+class LeanBee(LeanAgent, Bee):
+    '''
+    Bee with its state in slots and shared images, see Common.lean
+    '''
+    __slots__ = ("state", "t_step", "d_step", "w_step", "moves")
 
 
 class Selection(Enum):
@@ -116,7 +178,112 @@ class Selection(Enum):
     D = auto()
 
 
-class AggregationLive(Simulation):
+class BeeStates:
+    '''
+    Struct-of-arrays copy of the state machine of every bee, one row per bee
+    '''
+
+    columns = ("state", "t_step", "d_step", "w_step")
+
+    def __init__(self, bees: list[Bee]):
+        self.bees = bees
+        self.ids = [bee.id for bee in bees]
+        for column in self.columns:
+            setattr(self, column, np.array([getattr(bee, column) for bee in bees], dtype=np.int64))
+
+    def step(self, in_proximity, pos, move, on_site, p: AggregationParameters, streams):
+        '''
+        Advances every bee one frame, in the same order as Bee.change_position, and returns how often each
+        bee moves this frame. pos are the positions at the start of the frame, after wrapping around the window.
+        on_site(rows, at) tells for the rows of a mask whether they are on a site at the positions at, which
+        are checked where the bees check: after the move of a wandering bee, and at the end of a join after
+        the moves so far. The join and leave rolls are the ones the bees would draw themselves.
+        '''
+        a, b, t, d, w = p.a, p.b, p.t, p.d, p.w
+        state, t_step, d_step, w_step = self.state, self.t_step, self.d_step, self.w_step
+        join_roll, leave_roll = streams.rows("bee.join", self.ids), streams.rows("bee.leave", self.ids)
+        moves = np.zeros(len(state), dtype=np.int64)
+
+        # wandering
+        wandering = state == 0
+        moves[wandering] += 1
+        landed = np.zeros(len(state), dtype=bool)
+        landed[wandering] = on_site(wandering, pos[wandering] + move[wandering])
+        p_join = 0.03 + 0.48 * (1 - np.exp(-a * in_proximity))
+        state[wandering & landed & (w_step == 0) & (p_join > join_roll)] = 1
+        w_step[wandering & landed & (w_step != 0)] += 1
+        w_step[wandering & (w_step == w)] = 0
+
+        # joining
+        joining = state == 1
+        t_step[joining] += 1
+        joined = joining & (t_step == t)
+        t_step[joined] = 0
+        arrived = on_site(joined, pos[joined] + moves[joined, np.newaxis] * move[joined])
+        state[joined] = np.where(arrived, 2, 0)
+        moves[joining & ~joined] += 1
+
+        # still
+        still = state == 2
+        d_step[still] += 1
+        evaluate = still & (d_step == d)
+        d_step[evaluate] = 0
+        state[evaluate & (np.exp(-b * in_proximity) > leave_roll)] = 3
+
+        # leaving
+        leaving = state == 3
+        t_step[leaving] += 1
+        left = leaving & (t_step == w)
+        t_step[left] = 0
+        state[left] = 0
+        moves[leaving & ~left] += 1
+
+        return moves
+
+
+class AggregationSimulation(HeadlessSimulation):
+    '''
+    Aggregation with the neighbour index, which in vectorized mode advances all bees through BeeStates
+    before they move and pushes the new state and number of moves back to the agents. Both modes make the
+    same transitions with the same random numbers, so their per-frame counts are identical.
+    '''
+    config: AggregationConfig
+    states: Optional[BeeStates] = None
+
+    def __init__(self, config: AggregationConfig):
+        super().__init__(config)
+        use_neighbour_index(self)
+        use_random_streams(self, {"bee.join": "uniform", "bee.leave": "uniform"})
+
+    def before_update(self):
+        super().before_update()
+
+        if self.shared.parameters.vectorized:
+            self.step_bees()
+
+    def step_bees(self):
+        index = self._proximity
+        bees = [agent for agent in self._agents if isinstance(agent, Bee)]
+        if self.states is None or self.states.ids != [bee.id for bee in bees]:
+            self.states = BeeStates(bees)
+
+        # counted on the index of the last frame like Bee.count does, before any bee moved
+        in_proximity = index.counts_of(bees)
+        for bee in bees:
+            bee.there_is_no_escape()
+        pos = np.array([bee.pos for bee in bees], dtype=float).reshape(-1, 2)
+        move = np.array([bee.move for bee in bees], dtype=float).reshape(-1, 2)
+
+        def on_site(rows, at):
+            return index.site_ids_at([bees[row] for row in np.nonzero(rows)[0].tolist()], at) >= 0
+
+        states = self.states
+        moves = states.step(in_proximity, pos, move, on_site, self.shared.parameters, self.shared.streams)
+        for bee, *values in zip(bees, moves.tolist(), *(getattr(states, column).tolist() for column in states.columns)):
+            bee.moves, bee.state, bee.t_step, bee.d_step, bee.w_step = values
+
+
+class AggregationLive(AggregationSimulation, Simulation):
     selection: Selection = Selection.D
     config: AggregationConfig
 
@@ -129,6 +296,7 @@ class AggregationLive(Simulation):
             self.config.t += by
         elif self.selection == Selection.D:
             self.config.d += by
+        publish_parameters(self)
 
     def before_update(self):
         super().before_update()
@@ -148,30 +316,108 @@ class AggregationLive(Simulation):
                 elif event.key == pg.K_4:
                     self.selection = Selection.D
 
-        a, b, t, d, _ = self.config.weights()
-        # print(f"A: {a:.1f} - C: {b:.1f} - T: {t:.1f} - D {d: .1f}")
-
-df = (
-    AggregationLive(
-        AggregationConfig(
-            image_rotation=True,
-            movement_speed=2.0,
-            radius=25,
-            seed=30,
-            fps_limit=60,
-            duration=8000
-        )
-    )
+        # p = self.shared.parameters
+        # print(f"A: {p.a:.1f} - C: {p.b:.1f} - T: {p.t:.1f} - D {p.d: .1f}")
+
+
+def populate(simulation, bees: int = 100, counts_path: Optional[Path] = None):
+    simulation.config.draw_join_buffer()
+    publish_parameters(simulation)
+    use_counting_metrics(simulation, ["site_id"], path=counts_path)
+    return (
+        use_stop_conditions(simulation, simulation.config.stop_conditions())
         .spawn_site("site_medium.png", 200, 500)
         .spawn_site("site_medium.png", 700, 500)
-        .batch_spawn_agents(100, Bee, images=["bees.png"])
-        .run()
-        .snapshots.groupby(["frame","site_id"])
-        .agg(pl.count("id").alias("agent"))
-        .sort(["frame", "site_id"])
+        .batch_spawn_agents(bees, LeanBee if simulation.config.lean else Bee, images=["bees.png"])
+    )
+
+
+def site_counts(counts: pl.DataFrame) -> pl.DataFrame:
+    return counts.rename({"count": "agent"}).sort(["frame", "site_id"])
+
+
+def run_simulation(config: AggregationConfig, checkpoint: Optional[Path] = None, every: int = 1000,
+                   frames: Optional[FrameRing] = None, counts_path: Optional[Path] = None) -> Optional[pl.DataFrame]:
+    '''
+    Runs the two-site aggregation headless and returns the number of bees per site per frame. With a checkpoint
+    path the run is saved there every `every` frames and continues from it when it already exists. With a
+    FrameRing the (frame, site_id, count) rows are written to it as the run goes and nothing is returned. With a
+    counts_path those rows go to that csv every 1000 frames instead of staying in memory, and are read back once
+    the run ends.
+    '''
+    simulation = populate(AggregationSimulation(config), counts_path=counts_path)
+    if frames is not None:
+        use_frame_ring(simulation, frames)
+    if checkpoint is not None:
+        use_checkpoints(simulation, checkpoint, every)
+    if frames is not None:
+        simulation.run()
+        return None
+    return site_counts(simulation.run().counts)
+
+
+def first_divergence(config: AggregationConfig) -> Optional[int]:
+    '''
+    Runs config headless once per agent and once vectorized, returns the first frame where the bees per site
+    differ, None when both runs count the same bees on every frame
+    '''
+    per_agent, vectorized = (run_simulation(replace(config, vectorized=flag)) for flag in (False, True))
+    differing = (
+        per_agent.join(vectorized, on=["frame", "site_id"], how="full", suffix="_vectorized", coalesce=True)
+        .filter(pl.col("agent").ne_missing(pl.col("agent_vectorized")))
+    )
+    return None if differing.is_empty() else int(differing["frame"].min())
+
+
+def main():
+    import seaborn as sns
+
+    parser = argparse.ArgumentParser(description="Live two-site aggregation, stores and plots the bees per site")
+    parser.add_argument("--seed", type=int, default=30)
+    parser.add_argument("--duration", type=int, default=8000)
+    parser.add_argument("--out", type=Path, default=Path("results"))
+    parser.add_argument("--stationary", type=int, default=None,
+                        help="end the run once the occupancy stopped drifting over this many frames")
+    parser.add_argument("--checkpoint", type=Path, default=None,
+                        help="save the run here every 1000 frames and continue from it if it exists")
+    parser.add_argument("--lean", action="store_true", help="memory-lean bees for very large swarms")
+    parser.add_argument("--control", type=int, default=None, metavar="PORT",
+                        help="serve a loopback control channel on this port (0 for any free one)")
+    parser.add_argument("--counts", type=Path, default=None,
+                        help="write the counts to this csv as the run goes instead of keeping them in memory")
+    parser.add_argument("--check-paths", action="store_true",
+                        help="run headless per agent and vectorized and report the first frame their counts differ")
+    args = parser.parse_args()
+
+    config = AggregationConfig(
+        image_rotation=True,
+        movement_speed=2.0,
+        radius=25,
+        seed=args.seed,
+        fps_limit=60,
+        duration=args.duration,
+        stationary_window=args.stationary,
+        lean=args.lean,
+    )
+    if args.check_paths:
+        frame = first_divergence(config)
+        print("per-agent and vectorized counts match" if frame is None else f"paths differ from frame {frame}")
+        sys.exit(frame is not None)
+
+    simulation = populate(AggregationLive(config), counts_path=args.counts)
+    if args.control is not None:
+        use_control_channel(simulation, args.control)
+    if args.checkpoint is not None:
+        use_checkpoints(simulation, args.checkpoint)
+    df = site_counts(simulation.run().counts)
+    print(ResultStore(args.out, ["seed"]).write("aggregation", df, config))
+    if args.checkpoint is not None:
+        args.checkpoint.unlink(missing_ok=True)
+
+    plot = sns.relplot(x=df["frame"], y=df['agent'], hue=df["site_id"], kind='line')
 
-)
+    plot.savefig(f"plot_{args.seed}.png", dpi=300)
 
-plot = sns.relplot(x=df["frame"], y=df['agent'], hue=df["site_id"], kind='line')
 
-plot.savefig("plot.png", dpi=300)
+if __name__ == "__main__":
+    main()
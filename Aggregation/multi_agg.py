@@ -1,14 +1,112 @@
+import argparse
 import os
-from multiprocessing import Pool
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
 
-processes = ('aggregation_part2.py', 'aggregation_part3.py', 'aggregation_part4.py')
+import polars as pl
+from vi.config import Config
 
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+import aggregation_part2
+from Common.transport import FrameRing
 
-def run_process(process):
-    os.system('python {}'.format(process))
+# seconds between two looks at the rows the workers streamed
+POLL = 0.5
+
+
+@dataclass
+class Job:
+    name: str
+    run: Callable[[Config], pl.DataFrame]  # module-level scenario function, so it can be sent to a worker
+    config: Config
+    # save_data columns the run counts per frame: when given, run takes a FrameRing as frames and the counts
+    # come back through shared memory as they are made, turned into the result by tidy
+    counted: Optional[list[str]] = None
+    tidy: Optional[Callable[[pl.DataFrame], pl.DataFrame]] = None
+
+
+@dataclass
+class Result:
+    name: str
+    seconds: float
+    df: Optional[pl.DataFrame] = None
+    error: Optional[str] = None
+
+
+def execute(job: Job, ring: Optional[tuple] = None) -> Result:
+    '''
+    Runs one scenario inside a worker and times it, failures are returned instead of raised. With the spec of a
+    FrameRing the run writes its counts there and the result carries no table.
+    '''
+    start = time.perf_counter()
+    try:
+        if ring is None:
+            df = job.run(job.config)
+        else:
+            df = job.run(job.config, frames=FrameRing.attach(ring))
+    except Exception:
+        return Result(job.name, time.perf_counter() - start, error=traceback.format_exc())
+    return Result(job.name, time.perf_counter() - start, df=df)
+
+
+def run_jobs(jobs: list[Job], workers: Optional[int] = None) -> list[Result]:
+    '''
+    Runs the jobs headless in worker processes and returns their results in job order. The counts of jobs with
+    counted columns are read from their FrameRing while they run, which also shows how far they got.
+    '''
+    rings = {i: FrameRing.create(["frame", *job.counted, "count"]) for i, job in enumerate(jobs) if job.counted}
+    chunks = {i: [] for i in rings}
+    results = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = {executor.submit(execute, job, rings[i].spec if i in rings else None): i
+                       for i, job in enumerate(jobs)}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=POLL, return_when=FIRST_COMPLETED)
+                for i, ring in rings.items():
+                    rows = ring.read()
+                    if rows.height:
+                        chunks[i].append(rows)
+                if pending and chunks:
+                    print("  ".join(f"{jobs[i].name}: frame {parts[-1]['frame'][-1]}"
+                                    for i, parts in chunks.items() if parts), flush=True)
+
+                for future in done:
+                    i = futures[future]
+                    result = results[i] = future.result()
+                    if i in rings and not result.error:
+                        result.df = jobs[i].tidy(pl.concat([*chunks[i], rings[i].read()]))
+                    status = "failed" if result.error else f"{result.df.height} rows"
+                    print(f"{result.name}: {status} in {result.seconds:.1f}s")
+    finally:
+        for ring in rings.values():
+            ring.release()
+
+    return [results[i] for i in range(len(jobs))]
+
+
+# aggregation_part1.run_simulation fits a Job as well, but its site and bee images are not in the repository
+jobs = [
+    Job("part2", aggregation_part2.run_simulation, aggregation_part2.AggregationConfig(
+        movement_speed=2.0,
+        radius=25,
+        seed=30,
+        duration=8000,
+    ), counted=["site_id"], tidy=aggregation_part2.site_counts),
+]
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the aggregation scenarios headless in parallel")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
 
-    pool = Pool(processes=3)
-    pool.map(run_process, processes)
+    for result in run_jobs(jobs, args.workers):
+        if result.error:
+            print(f"{result.name} failed:\n{result.error}")
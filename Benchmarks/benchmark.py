@@ -0,0 +1,276 @@
+import argparse
+import importlib
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import polars as pl
+
+ROOT = Path(__file__).resolve().parents[1]
+
+SIZES = [50, 200, 1000, 5000, 20000]
+
+
+@dataclass
+class Scenario:
+    directory: str  # scenario folder, its modules are imported from and its images loaded relative to it
+    build: Callable[[int, int], Callable[[], object]]  # (agents, seed) -> step function advancing one frame
+
+
+@dataclass
+class Case:
+    scenario: str
+    agents: int
+    frames: int
+    warmup: int
+    seed: int
+
+
+def window(side: int, agents: int, base_agents: int):
+    '''
+    Square window that keeps the density of the scenario constant above its base population, so the
+    number of neighbours per agent stays the same and only the population grows
+    '''
+    from vi import Window
+    return Window.square(round(side * math.sqrt(max(agents, base_agents) / base_agents)))
+
+
+def flocking(vectorized: bool):
+    def build(agents: int, seed: int):
+        flocking = importlib.import_module("flocking")
+        config = flocking.FlockingConfig(
+            image_rotation=True,
+            movement_speed=1.0,
+            radius=35,
+            seed=seed,
+            window=window(750, agents, 1000),
+            vectorized=vectorized,
+        )
+        return flocking.FlockingSimulation(config).batch_spawn_agents(agents, flocking.Bird, ["green.png"]).tick
+
+    return build
+
+
+def aggregation(vectorized: bool, lean: bool = False):
+    def build(agents: int, seed: int):
+        aggregation = importlib.import_module("aggregation_part2")
+        config = aggregation.AggregationConfig(
+            image_rotation=True,
+            movement_speed=2.0,
+            radius=25,
+            seed=seed,
+            window=window(750, agents, 100),
+            vectorized=vectorized,
+            lean=lean,
+        )
+        return aggregation.populate(aggregation.AggregationSimulation(config), agents).tick
+
+    return build
+
+
+def competition(vectorized: bool, lean: bool = False):
+    def build(agents: int, seed: int):
+        competition = importlib.import_module("Competition")
+        config = competition.CompetitionConfig(
+            image_rotation=True,
+            movement_speed=1.5,
+            radius=45,
+            seed=seed,
+            window=window(700, agents, 200),
+            vectorized=vectorized,
+            lean=lean,
+        )
+        simulation = competition.CompetitionSimulation(config)
+        return competition.populate(simulation, agents // 2, agents - agents // 2).tick
+
+    return build
+
+
+def competition_arrays(agents: int, seed: int):
+    competition = importlib.import_module("Competition")
+    array_simulation = importlib.import_module("array_simulation")
+    config = competition.CompetitionConfig(movement_speed=1.5, radius=45, seed=seed, window=window(700, agents, 200))
+    return array_simulation.ArrayCompetition(config, agents // 2, agents - agents // 2).step
+
+
+SCENARIOS = {
+    "flocking": Scenario("Flocking", flocking(vectorized=True)),
+    "flocking-per-agent": Scenario("Flocking", flocking(vectorized=False)),
+    "aggregation": Scenario("Aggregation", aggregation(vectorized=True)),
+    "aggregation-per-agent": Scenario("Aggregation", aggregation(vectorized=False)),
+    "aggregation-lean": Scenario("Aggregation", aggregation(vectorized=True, lean=True)),
+    "competition": Scenario("Competition", competition(vectorized=True)),
+    "competition-per-agent": Scenario("Competition", competition(vectorized=False)),
+    "competition-lean": Scenario("Competition", competition(vectorized=True, lean=True)),
+    "competition-arrays": Scenario("Competition", competition_arrays),
+}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def rss_mb() -> float:
+    '''
+    Resident memory right now, the peak where /proc is not available
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def measure(case: Case) -> dict:
+    '''
+    Builds one scenario headless and times every frame, runs in its own process so peak RSS is its own
+    '''
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    scenario = SCENARIOS[case.scenario]
+    directory = ROOT / scenario.directory
+    os.chdir(directory)
+    sys.path.insert(0, str(directory))
+
+    # an empty build first, so imports, images and pygame are paid before the per-agent memory is measured
+    scenario.build(0, case.seed)
+    empty_rss = rss_mb()
+
+    step = scenario.build(case.agents, case.seed)
+    for _ in range(case.warmup):
+        step()
+    setup_rss = peak_rss_mb()
+    bytes_per_agent = (rss_mb() - empty_rss) * 2 ** 20 / max(case.agents, 1)
+
+    frame_times = np.empty(case.frames)
+    for frame in range(case.frames):
+        start = time.perf_counter()
+        step()
+        frame_times[frame] = time.perf_counter() - start
+
+    p50, p90, p99 = np.percentile(frame_times, [50, 90, 99]) * 1000
+    return {
+        **asdict(case),
+        "seconds": frame_times.sum(),
+        "fps": case.frames / frame_times.sum(),
+        "mean_ms": frame_times.mean() * 1000,
+        "p50_ms": p50,
+        "p90_ms": p90,
+        "p99_ms": p99,
+        "max_ms": frame_times.max() * 1000,
+        "setup_rss_mb": setup_rss,
+        "bytes_per_agent": bytes_per_agent,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_case(case: Case) -> dict:
+    # a fresh interpreter per case, so neither imports nor the heap of earlier cases count towards its RSS
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(measure, case).result()
+
+
+def benchmark(scenarios: list[str], sizes: list[int], frames: int, warmup: int, seed: int,
+              max_seconds: float) -> pl.DataFrame:
+    '''
+    Runs every scenario at every population size, one after the other so cases do not compete for cores.
+
+    Once a case of a scenario takes longer than max_seconds the larger sizes of that scenario are skipped,
+    which keeps the per-agent reference paths from running for hours at 20k agents.
+    '''
+    rows = []
+    for scenario in scenarios:
+        for agents in sorted(sizes):
+            row = run_case(Case(scenario, agents, frames, warmup, seed))
+            rows.append(row)
+            print(f"{scenario:>22} {agents:>6} agents: {row['fps']:8.1f} fps, p50 {row['p50_ms']:7.2f} ms, "
+                  f"p99 {row['p99_ms']:7.2f} ms, peak {row['peak_rss_mb']:6.0f} MB, "
+                  f"{row['bytes_per_agent']:6.0f} B/agent")
+            if row["seconds"] > max_seconds:
+                print(f"{scenario:>22} skipping sizes above {agents}, the case took {row['seconds']:.0f}s")
+                break
+
+    return pl.DataFrame(rows)
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def store(df: pl.DataFrame, out: Path, label: str) -> Path:
+    '''
+    Writes a benchmark run as out/<label>.parquet, tagged with the revision and machine it ran on
+    '''
+    out.mkdir(parents=True, exist_ok=True)
+    path = out / f"{label}.parquet"
+    df.with_columns(
+        pl.lit(label).alias("label"),
+        pl.lit(revision()).alias("revision"),
+        pl.lit(platform.node()).alias("machine"),
+        pl.lit(platform.python_version()).alias("python"),
+        pl.lit(datetime.now(timezone.utc).isoformat(timespec="seconds")).alias("timestamp"),
+    ).write_parquet(path)
+    return path
+
+
+def compare(baseline: pl.DataFrame, current: pl.DataFrame) -> pl.DataFrame:
+    '''
+    Speed and memory of current relative to baseline for every (scenario, agents) both runs have,
+    ratios below 1 mean current is slower or uses more memory
+    '''
+    keys = ["scenario", "agents"]
+    columns = ["fps", "p99_ms", "peak_rss_mb", "bytes_per_agent"]
+    return (
+        baseline.select(keys + columns)
+        .join(current.select(keys + columns), on=keys, suffix="_current")
+        .select(
+            *keys,
+            pl.col("fps_current").alias("fps"),
+            (pl.col("fps_current") / pl.col("fps")).alias("fps_ratio"),
+            (pl.col("p99_ms") / pl.col("p99_ms_current")).alias("p99_ratio"),
+            (pl.col("peak_rss_mb") / pl.col("peak_rss_mb_current")).alias("rss_ratio"),
+            (pl.col("bytes_per_agent") / pl.col("bytes_per_agent_current")).alias("bytes_per_agent_ratio"),
+        )
+        .sort(keys)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times every scenario headless at growing population sizes")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-seconds", type=float, default=120)
+    parser.add_argument("--label", default=None, help="name of the stored run, the git revision by default")
+    parser.add_argument("--out", type=Path, default=ROOT / "Benchmarks" / "results")
+    parser.add_argument("--compare", type=Path, default=None, help="stored run to compare against")
+    args = parser.parse_args()
+
+    df = benchmark(args.scenarios, args.sizes, args.frames, args.warmup, args.seed, args.max_seconds)
+    print(store(df, args.out, args.label or revision()))
+
+    if args.compare is not None:
+        with pl.Config(tbl_rows=-1, tbl_cols=-1):
+            print(compare(pl.read_parquet(args.compare), df))
+
+
+if __name__ == "__main__":
+    main()
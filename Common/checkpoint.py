@@ -0,0 +1,190 @@
+import dataclasses
+import os
+import pickle
+import random
+from pathlib import Path
+
+import numpy as np
+from pygame.math import Vector2
+from pygame.sprite import Sprite
+
+from Common.parameters import publish_parameters
+
+# agent attributes that point back into the simulation or are caches, everything else is agent state
+FRAMEWORK_ATTRIBUTES = {"_Sprite__g", "_Agent__simulation", "config", "shared", "_images", "_obstacles", "_sites",
+                        "_area", "_image_cache"}
+
+FORMAT = 1
+
+
+class Departed:
+    '''
+    Stands in for an agent that died before the checkpoint but still has a row in the neighbour index
+    '''
+
+    def __init__(self, id: int):
+        self.id = id
+
+    def alive(self) -> bool:
+        return False
+
+    def on_site(self) -> bool:
+        return False
+
+
+def write_checkpoint(path: Path, state: dict):
+    '''
+    Pickles state next to path and moves it in place, so a job killed while writing keeps its previous checkpoint
+    '''
+    path = Path(path)
+    partial = path.with_suffix(".partial")
+    with open(partial, "wb") as f:
+        pickle.dump({"format": FORMAT, **state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(partial, path)
+
+
+def read_checkpoint(path: Path) -> dict:
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    if state.pop("format") != FORMAT:
+        raise ValueError(f"{path} was written by an incompatible version of the checkpoint format")
+    return state
+
+
+def agent_columns(agents: list) -> dict:
+    '''
+    The state of every agent, grouped per class into columns: positions and moves as float arrays, every other
+    attribute as a list. kinds keeps the group of every agent, so they can be recreated in their original order.
+    '''
+    classes = {}
+    kinds = [classes.setdefault(type(agent), len(classes)) for agent in agents]
+
+    groups = []
+    for cls in classes:
+        members = [agent for agent in agents if type(agent) is cls]
+        slots = {name for klass in cls.__mro__ for name in vars(klass).get("__slots__", ())}
+        attributes = sorted(({name for agent in members for name in vars(agent)} | slots) - FRAMEWORK_ATTRIBUTES
+                            - {"pos", "move"})
+        groups.append({
+            "class": cls,
+            "pos": np.array([agent.pos for agent in members], dtype=float).reshape(-1, 2),
+            "move": np.array([agent.move for agent in members], dtype=float).reshape(-1, 2),
+            "attributes": {name: [getattr(agent, name, None) for agent in members]
+                           for name in attributes},
+        })
+    return {"kinds": kinds, "groups": groups}
+
+
+def simulation_state(simulation) -> dict:
+    '''
+    Everything needed to continue a HeadlessSimulation from the current frame: config, RNG states, agents,
+    metrics, the neighbour index of the last frame and whatever the simulation itself adds in
+    checkpoint_state()
+    '''
+    index = simulation._proximity
+    metrics = {name: value for name, value in vars(simulation._metrics).items() if not callable(value)}
+    state = {
+        "config": simulation.config,
+        "counter": simulation.shared.counter,
+        "next_agent_id": simulation._next_agent_id,
+        "random": random.getstate(),
+        "prng_move": simulation.shared.prng_move.getstate(),
+        "numpy": np.random.get_state(),
+        "agents": agent_columns(simulation._agents.sprites()),
+        "metrics": metrics,
+    }
+    if hasattr(index, "pairs"):
+        index.site_id_rows()  # while every indexed agent is still around to be checked against the sites
+        state["index"] = {
+            "ids": [agent.id for agent in index.agents],
+            **{name: getattr(index, name) for name in ("pos", "kind", "_kinds", "_site_ids", "i", "j", "dist",
+                                                        "_indptr")},
+        }
+    if hasattr(simulation.shared, "streams"):
+        state["streams"] = simulation.shared.streams.seed
+    if hasattr(simulation, "checkpoint_state"):
+        state["simulation"] = simulation.checkpoint_state()
+    return state
+
+
+def restore_simulation(simulation, state: dict):
+    '''
+    Puts a freshly built and populated simulation (same scenario, same sites) into the state of a checkpoint.
+    The spawned agents only provide the images of every class, they are replaced by the checkpointed ones.
+    '''
+    images = {type(agent): agent._images for agent in simulation._agents}
+    for agent in simulation._agents.sprites():
+        Sprite.kill(agent)  # right away, not at the end of a frame like an agent pool would
+
+    # the agents share the config object, so it is updated in place
+    for field in dataclasses.fields(state["config"]):
+        setattr(simulation.config, field.name, getattr(state["config"], field.name))
+    if hasattr(simulation.shared, "parameters"):
+        publish_parameters(simulation)
+
+    created = {}
+    groups = state["agents"]["groups"]
+    cursors = [0] * len(groups)
+    for kind in state["agents"]["kinds"]:
+        group, k = groups[kind], cursors[kind]
+        cursors[kind] += 1
+
+        cls = group["class"]
+        agent = cls(images=images[cls], simulation=simulation, pos=Vector2(*group["pos"][k].tolist()),
+                    move=Vector2(*group["move"][k].tolist()))
+        for name, values in group["attributes"].items():
+            setattr(agent, name, values[k])
+        created[agent.id] = agent
+
+    simulation._next_agent_id = state["next_agent_id"]
+    simulation.shared.counter = state["counter"]
+    random.setstate(state["random"])
+    simulation.shared.prng_move.setstate(state["prng_move"])
+    np.random.set_state(state["numpy"])
+    vars(simulation._metrics).update(state["metrics"])
+    if hasattr(simulation._metrics, "rewind"):
+        simulation._metrics.rewind(state["counter"])
+    if "streams" in state:
+        simulation.shared.streams.seed = state["streams"]
+
+    if "index" in state:
+        index = simulation._proximity
+        saved = dict(state["index"])
+        index.agents = [created.get(id) or Departed(id) for id in saved.pop("ids")]
+        index._rows = {agent.id: row for row, agent in enumerate(index.agents)}
+        index._views = {}
+        for name, value in saved.items():
+            setattr(index, name, value)
+
+    if "simulation" in state:
+        simulation.restore_checkpoint_state(state["simulation"], created)
+    return simulation
+
+
+class CheckpointedTick:
+    '''
+    Writes a checkpoint after every `every` frames
+    '''
+
+    def __init__(self, simulation, tick, path: Path, every: int):
+        self.simulation = simulation
+        self.tick = tick
+        self.path = path
+        self.every = every
+
+    def __call__(self):
+        self.tick()
+        simulation = self.simulation
+        if simulation._running and simulation.shared.counter % self.every == 0:
+            write_checkpoint(self.path, simulation_state(simulation))
+
+
+def use_checkpoints(simulation, path: Path, every: int = 1000):
+    '''
+    Checkpoints the simulation to path every `every` frames, and when path already exists first resumes from
+    it. Call this after populating the simulation and after the other use_* hooks.
+    '''
+    if Path(path).exists():
+        restore_simulation(simulation, read_checkpoint(path))
+    simulation.tick = CheckpointedTick(simulation, simulation.tick, path, every)
+    return simulation
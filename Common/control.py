@@ -0,0 +1,203 @@
+import asyncio
+import ipaddress
+import json
+import queue
+import threading
+from dataclasses import fields
+
+from Common.parameters import publish_parameters
+
+# bytes a subscriber may fall behind before its frames are dropped instead of buffered
+SUBSCRIBER_BACKLOG = 64 * 1024
+
+# parameters that change how the state of the agents is kept, they can not be switched while running
+FIXED_PARAMETERS = {"vectorized"}
+
+
+def coerce(current, value):
+    '''
+    value as the type of the current setting, None when it does not fit: bools stay bools, ints stay ints
+    and floats take any number
+    '''
+    if isinstance(current, bool):
+        return value if isinstance(value, bool) else None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if isinstance(current, int):
+        return value if isinstance(value, int) else None
+    return float(value)
+
+
+class ControlChannel:
+    '''
+    Loopback control channel of a running simulation: a TCP server speaking one JSON object per line, served
+    by an asyncio loop in a daemon thread so the simulation never waits on a client.
+
+        {"set": {"hunger": 30, "r_rep": 0.8}}   changes settings, applied together at the start of the next frame
+        {"get": "parameters"}                   the parameter block the agents read
+        {"subscribe": true}                     streams {"frame", "agents", "counts"} after every frame
+
+    Every request is answered with {"ok": ...} or {"error": ...}. Only the fields of the config's parameter
+    block can be set. A subscriber that reads slower than the simulation runs misses frames instead of
+    holding the simulation back or growing a buffer.
+    '''
+
+    def __init__(self, simulation, port: int = 0, host: str = "127.0.0.1"):
+        if not ipaddress.ip_address(host).is_loopback:
+            raise ValueError(f"the control channel only listens on loopback addresses, not {host}")
+
+        self.simulation = simulation
+        config = simulation.config
+        self.settable = {field.name: getattr(config, field.name) for field in fields(config.parameters())
+                         if field.name not in FIXED_PARAMETERS}
+
+        self.updates = queue.SimpleQueue()  # dicts of accepted settings, from the loop thread to the simulation
+        self.subscribers = set()  # StreamWriters, only touched in the loop thread
+
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._serve, args=(host, port, started), daemon=True)
+        self.thread.start()
+        started.wait()
+        self.address = self.server.sockets[0].getsockname()[:2]
+
+    def _serve(self, host: str, port: int, started: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self._client, host, port))
+        started.set()
+        self.loop.run_forever()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            async for line in reader:
+                writer.write(json.dumps(self._answer(line, writer)).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    def _answer(self, line: bytes, writer: asyncio.StreamWriter) -> dict:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"error": "not a JSON line"}
+        if not isinstance(request, dict):
+            return {"error": "expected a JSON object"}
+
+        if "set" in request:
+            return self._set(request["set"])
+        if request.get("get") == "parameters":
+            return {"ok": {field.name: getattr(self.simulation.shared.parameters, field.name)
+                           for field in fields(self.simulation.shared.parameters)}}
+        if "subscribe" in request:
+            if request["subscribe"]:
+                self.subscribers.add(writer)
+            else:
+                self.subscribers.discard(writer)
+            return {"ok": bool(request["subscribe"])}
+        return {"error": "expected set, get or subscribe"}
+
+    def _set(self, settings) -> dict:
+        if not isinstance(settings, dict):
+            return {"error": "set takes an object of settings"}
+
+        accepted = {}
+        for name, value in settings.items():
+            if name not in self.settable:
+                return {"error": f"{name} can not be set, settable are {', '.join(self.settable)}"}
+            accepted[name] = coerce(self.settable[name], value)
+            if accepted[name] is None:
+                return {"error": f"{name} takes a {type(self.settable[name]).__name__}, not {value!r}"}
+
+        # queued as one batch, so the settings of a request take effect in the same frame
+        self.updates.put(accepted)
+        return {"ok": accepted}
+
+    def apply(self):
+        '''
+        Applies the settings that came in since the last frame, called by the simulation between frames
+        '''
+        changed = False
+        while True:
+            try:
+                settings = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            for name, value in settings.items():
+                setattr(self.simulation.config, name, value)
+            changed = True
+        if changed:
+            publish_parameters(self.simulation)
+
+    def publish(self, frame: int):
+        '''
+        Hands the numbers of the frame that just ended to the loop thread, which writes them to the subscribers.
+        frame is the counter the frame ran with, as in the counts of CountingMetrics and FrameRing rows.
+        '''
+        if not self.subscribers:
+            return
+        simulation = self.simulation
+        row = {"frame": frame, "agents": len(simulation._agents)}
+        counts = getattr(simulation._metrics, "frame_counts", None)
+        if counts is not None:
+            row["counts"] = {"/".join(map(str, values)): count for values, count in counts.items()}
+        self.loop.call_soon_threadsafe(self._broadcast, row)
+
+    def _broadcast(self, row: dict):
+        line = json.dumps(row).encode() + b"\n"
+        for writer in self.subscribers:
+            if writer.transport.get_write_buffer_size() < SUBSCRIBER_BACKLOG:
+                writer.write(line)
+
+    def close(self):
+        def shutdown():
+            self.server.close()
+            for writer in self.subscribers:
+                writer.close()
+            self.loop.stop()
+
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(shutdown)
+            self.thread.join()
+        self.loop.close()
+
+
+class ControlledTick:
+    '''
+    Applies the settings received by the control channel before every frame and publishes its numbers after
+    '''
+
+    def __init__(self, channel: ControlChannel, tick):
+        self.channel = channel
+        self.tick = tick
+
+    def __call__(self):
+        self.channel.apply()
+        # read before the tick, the last frame of a run does not advance the counter
+        frame = self.channel.simulation.shared.counter
+        self.tick()
+        self.channel.publish(frame)
+
+
+def use_control_channel(simulation, port: int = 0, host: str = "127.0.0.1"):
+    '''
+    Serves a ControlChannel for the simulation on a loopback port (0 picks a free one) while it runs, kept as
+    simulation.control; its address is printed and the server is stopped once run() returns
+    '''
+    channel = simulation.control = ControlChannel(simulation, port, host)
+    simulation.tick = ControlledTick(channel, simulation.tick)
+    print("control channel on {}:{}".format(*channel.address))
+
+    run = simulation.run
+
+    def controlled_run():
+        try:
+            return run()
+        finally:
+            channel.close()
+
+    simulation.run = controlled_run
+    return simulation
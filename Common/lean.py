@@ -0,0 +1,109 @@
+import types
+
+import pygame as pg
+from pygame.math import Vector2
+from vi import Agent
+
+# rotations of the atlas per full turn, the image of an agent is the nearest one to its heading
+ROTATION_STEPS = 360
+
+UP = Vector2((0, -1))
+
+MISSING = object()
+
+
+class RotationAtlas(list):
+    '''
+    The images of a batch of agents together with their rotations and masks, built on first use and shared
+    by every agent spawned from the batch, so no agent keeps a surface of its own
+    '''
+
+    def __init__(self, images: list, steps: int = ROTATION_STEPS):
+        super().__init__(images)
+        self.steps = steps
+        self._rotated = {}  # (image index, step) -> (surface, mask)
+
+    def get(self, index: int, move: Vector2, rotate: bool) -> tuple:
+        step = round(move.angle_to(UP) * self.steps / 360) % self.steps if rotate else 0
+        entry = self._rotated.get((index, step))
+        if entry is None:
+            image = pg.transform.rotate(self[index], step * 360 / self.steps) if step else self[index]
+            entry = self._rotated[index, step] = (image, pg.mask.from_surface(image))
+        return entry
+
+
+class GroupList(list):
+    '''
+    The groups a sprite is in, with the part of the set interface pygame's Sprite uses. An agent is in two
+    groups, and a two element list takes about a third of the memory of the set Sprite starts with.
+    '''
+    __slots__ = ()
+
+    def add(self, group):
+        if group not in self:
+            self.append(group)
+
+
+def atlas_of(simulation, images: list) -> RotationAtlas:
+    '''
+    The atlas of a list of loaded images, one per list so every agent of a batch_spawn_agents call shares it
+    '''
+    if isinstance(images, RotationAtlas):
+        return images
+    atlases = vars(simulation).setdefault("_atlases", {})  # id of the image list -> (image list, atlas)
+    if id(images) not in atlases:
+        atlases[id(images)] = (images, RotationAtlas(images))
+    return atlases[id(images)][1]
+
+
+def slot_defaults(cls: type) -> dict:
+    '''
+    Every slot of cls with the class attribute it replaces as starting value, so a slotted subclass starts
+    out like the agent class it derives from
+    '''
+    defaults = {}
+    for name in (name for klass in cls.__mro__ for name in vars(klass).get("__slots__", ())):
+        for klass in cls.__mro__:
+            value = vars(klass).get(name, MISSING)
+            if value is not MISSING and not isinstance(value, types.MemberDescriptorType):
+                defaults[name] = value
+                break
+    return defaults
+
+
+class LeanAgent(Agent):
+    '''
+    Memory-lean base for agents in large populations, mixed in before the behaviour class:
+
+        class LeanRabbit(LeanAgent, Rabbit):
+            __slots__ = ("r_rep_buffer_t", "t_step", "state")
+
+    The behaviour state lives in the slots the subclass names, which start at the class defaults of the
+    behaviour class. Images, their rotations and masks come from a RotationAtlas shared by all agents of a
+    batch instead of a surface cached per agent, with headings rounded to 360 / ROTATION_STEPS degrees.
+    reproduce() hands position and move to the new agent directly, skipping the random spawn placement
+    that a copy would otherwise go through and then overwrite.
+    '''
+    __slots__ = ()
+    _slot_defaults: dict = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._slot_defaults = slot_defaults(cls)
+
+    def __init__(self, images: list, simulation, pos=None, move=None):
+        for name, value in self._slot_defaults.items():
+            setattr(self, name, value)
+        super().__init__(atlas_of(simulation, images), simulation, pos, move)
+        self._Sprite__g = GroupList(self._Sprite__g)
+
+    @property
+    def image(self) -> pg.Surface:
+        return self._images.get(self._image_index, self.move, self.config.image_rotation)[0]
+
+    @property
+    def mask(self) -> pg.mask.Mask:
+        return self._images.get(self._image_index, self.move, self.config.image_rotation)[1]
+
+    def __copy__(self):
+        return type(self)(self._images, self._Agent__simulation, self.pos.copy(), self.move.copy())
@@ -0,0 +1,91 @@
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Optional
+
+import polars as pl
+from vi import Metrics
+
+
+class CountingMetrics(Metrics):
+    '''
+    Drop-in replacement for the simulation metrics that reduces the save_data values of every frame to
+    per-frame counts as soon as the frame ends, instead of keeping a row per agent per frame.
+
+    Rows are buffered and flushed every chunk_size frames; with a path they are written to that csv
+    and dropped from memory, so memory stays constant no matter the duration. A run replaces what an
+    earlier run left in the csv, a run resumed from a checkpoint continues it.
+    '''
+
+    def __init__(self, columns: list[str], chunk_size: int = 1000, path: Optional[Path] = None):
+        super().__init__()
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.path = path
+
+        self._rows = []  # (frame, *values, count) rows of the current chunk
+        self._chunks = []  # flushed chunks, only kept when not writing to a path
+        self._written = False  # whether this run flushed to path yet
+        self._frames = 0
+        self.frame_counts = None  # Counter of the values of the last frame
+
+        self.stopping = None  # StopConditions checked on the counts of every frame, see Common.stopping
+        self.on_stop = None
+
+    def _merge(self):
+        snapshots = self._temporary_snapshots
+        self._temporary_snapshots = defaultdict(list)
+
+        frame = snapshots["frame"][0] if snapshots["frame"] else self._frames
+        counts = self.frame_counts = Counter(zip(*(snapshots[column] for column in self.columns)))
+        self._rows.extend((frame, *values, count) for values, count in sorted(counts.items()))
+
+        if self.stopping is not None and self.stopping.check(frame, counts):
+            self.on_stop()
+
+        self._frames += 1
+        if self._frames % self.chunk_size == 0:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+
+        chunk = pl.DataFrame(self._rows, schema=["frame", *self.columns, "count"], orient="row")
+        self._rows = []
+
+        if self.path is None:
+            self._chunks.append(chunk)
+        else:
+            with open(self.path, "ab" if self._written else "wb") as f:
+                chunk.write_csv(f, include_header=f.tell() == 0)
+            self._written = True
+
+    def rewind(self, frame: int):
+        '''
+        Drops the rows the csv got after a checkpoint of the given frame was written, called when a run resumes
+        from it
+        '''
+        if self.path is None or not self._written:
+            return
+        if self._rows:
+            frame = self._rows[0][0]  # not flushed at the checkpoint yet
+        pl.read_csv(self.path).filter(pl.col("frame") < frame).write_csv(self.path)
+
+    @property
+    def counts(self) -> pl.DataFrame:
+        '''
+        The (frame, *columns, count) table of the run so far
+        '''
+        self.flush()
+        if self.path is not None:
+            return pl.read_csv(self.path) if self._written else pl.DataFrame()
+        return pl.concat(self._chunks) if self._chunks else pl.DataFrame()
+
+
+def use_counting_metrics(simulation, columns: list[str], chunk_size: int = 1000, path: Optional[Path] = None):
+    '''
+    Replaces the metrics of a simulation with CountingMetrics, so run() returns the per-frame counts of the
+    given save_data columns in .counts instead of every agent's snapshot in .snapshots
+    '''
+    simulation._metrics = CountingMetrics(columns, chunk_size, path)
+    return simulation
@@ -0,0 +1,298 @@
+from typing import Optional
+
+import numpy as np
+from vi.proximity import ProximityEngine, ProximityIter
+
+# offsets of the 3x3 block of grid cells around a cell, encoded the same way as the cell keys
+CELL_SHIFT = 32
+CELL_BIAS = 1 << 31
+NEIGHBOUR_CELLS = [(dx << CELL_SHIFT) + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+# worlds stepped together get their own range of keys, far enough apart that no neighbour cell crosses into another
+WORLD_SHIFT = 48
+
+
+def cell_keys(pos, size):
+    '''
+    Encodes the grid cell of every position as a single int64 key
+    '''
+    cells = np.floor(pos / size).astype(np.int64)
+    return (cells[:, 0] << CELL_SHIFT) + cells[:, 1] + CELL_BIAS
+
+
+def expand_ranges(starts, ends):
+    '''
+    Concatenation of arange(start, end) for every pair, together with the pair it came from
+    '''
+    counts = ends - starts
+    owner = np.repeat(np.arange(len(starts)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, np.repeat(starts, counts) + offset
+
+
+def neighbour_pairs(pos, radius, world: Optional[np.ndarray] = None):
+    '''
+    All (i, j, distance) pairs of rows where j is within radius of i, grouped by i and sorted by distance.
+    Positions are bucketed into a grid with cells of size radius, so only the 3x3 cells around a row are compared.
+    With a world id per row the world is part of the cell key, and rows only pair up with rows of their own world.
+    '''
+    n = len(pos)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+
+    keys = cell_keys(pos, radius)
+    if world is not None:
+        keys += np.asarray(world, dtype=np.int64) << WORLD_SHIFT
+    order = np.argsort(keys, kind="stable")
+    cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+
+    i, j = [], []
+    for offset in NEIGHBOUR_CELLS:
+        wanted = keys + offset
+        at = np.minimum(np.searchsorted(cells, wanted), len(cells) - 1)
+        found = cells[at] == wanted
+        owner, sorted_rows = expand_ranges(np.where(found, starts[at], 0),
+                                           np.where(found, starts[at] + counts[at], 0))
+        i.append(owner)
+        j.append(order[sorted_rows])
+
+    i = np.concatenate(i)
+    j = np.concatenate(j)
+    dist = np.hypot(*(pos[i] - pos[j]).T)
+    keep = (dist <= radius) & (i != j)
+    i, j, dist = i[keep], j[keep], dist[keep]
+
+    by_distance = np.lexsort((dist, i))
+    return i[by_distance], j[by_distance], dist[by_distance]
+
+
+class NeighbourIndex(ProximityEngine):
+    '''
+    Uniform grid over all agent positions, built once per frame with cells the size of the configured radius.
+
+    Every neighbour pair within the radius is computed in one vectorized pass and stored sorted by distance,
+    so in_proximity_accuracy(), count(), nearest() and the kind/on-site filters are slices of those arrays.
+    The slices are memoized per agent until the next build (see NeighbourView), so an agent asking again in
+    the same frame gets its cached neighbours. Agents spawned after the last build are answered by a
+    brute-force pass over the indexed positions.
+    '''
+
+    def __init__(self, simulation):
+        super().__init__(simulation._agents, simulation.config.radius)
+        self._group = simulation._agents
+        self._sites = simulation._sites
+
+        self.agents = []  # row -> agent
+        self.pos = np.empty((0, 2))
+        self.kind = np.empty(0, dtype=np.int64)
+        self._kinds: dict[type, int] = {}
+        self._rows: dict[int, int] = {}  # agent id -> row
+        self._site_ids = None
+        self._masks: dict[int, tuple] = {}  # agent id -> (image, mask) it was last checked against the sites with
+        self._views: dict[int, NeighbourView] = {}  # agent id -> neighbours in the current frame
+
+        self.i = np.empty(0, dtype=np.int64)
+        self.j = np.empty(0, dtype=np.int64)
+        self.dist = np.empty(0)
+        self._indptr = np.zeros(1, dtype=np.int64)
+
+    def update(self):
+        '''
+        Rebuilds the grid and all neighbour pairs from the current agent positions
+        '''
+        self.agents = self._group.sprites()
+        n = len(self.agents)
+
+        self.pos = np.array([agent.pos for agent in self.agents], dtype=float).reshape(n, 2)
+        self.kind = np.array([self._kind_code(type(agent)) for agent in self.agents], dtype=np.int64)
+        self._rows = {agent.id: row for row, agent in enumerate(self.agents)}
+        self._site_ids = None
+        self._views = {}
+        if len(self._masks) > 2 * n:
+            self._masks = {id: entry for id, entry in self._masks.items() if id in self._rows}
+
+        self.i, self.j, self.dist = neighbour_pairs(self.pos, self.radius)
+        self._indptr = np.concatenate([[0], np.cumsum(np.bincount(self.i, minlength=n))])
+
+    def pairs(self):
+        '''
+        All (i, j, distance) row pairs where j is within the radius of i, grouped by i and sorted by distance
+        '''
+        return self.i, self.j, self.dist
+
+    def neighbour_counts(self):
+        '''
+        Number of agents within the radius of every row
+        '''
+        return np.diff(self._indptr)
+
+    def kind_rows(self, kind: type):
+        '''
+        Mask of the rows whose agent is an instance of kind
+        '''
+        return np.isin(self.kind, self._codes(kind))
+
+    def site_ids_at(self, agents: list, pos) -> np.ndarray:
+        '''
+        The id of the site every agent would be on at the matching row of pos, -1 for none: the same answer as
+        Agent.on_site_id() there, the first site in group order whose mask overlaps the agent's, with the
+        agent's rect centred on the rounded position. The rects are compared on the image sizes first, and only
+        agents whose rect overlaps a site get a mask, made once for as long as their image stays the same surface.
+        '''
+        n = len(agents)
+        ids = np.full(n, -1, dtype=np.int64)
+        sites = self._sites.sprites()
+        if n == 0 or not sites:
+            return ids
+
+        size = np.array([agent.image.get_size() for agent in agents], dtype=np.int64).reshape(n, 2)
+        topleft = np.rint(np.asarray(pos, dtype=float).reshape(n, 2)).astype(np.int64) - size // 2
+        bottomright = topleft + size
+
+        for site in sites:
+            left, top, width, height = site.rect
+            near = ((ids < 0) & (topleft[:, 0] < left + width) & (bottomright[:, 0] > left)
+                    & (topleft[:, 1] < top + height) & (bottomright[:, 1] > top))
+            for row in np.nonzero(near)[0].tolist():
+                x, y = topleft[row]
+                if self._mask(agents[row]).overlap(site.mask, (left - int(x), top - int(y))):
+                    ids[row] = site.id
+        return ids
+
+    def _mask(self, agent):
+        image = agent.image
+        entry = self._masks.get(agent.id)
+        if entry is None or entry[0] is not image:
+            entry = self._masks[agent.id] = (image, agent.mask)
+        return entry[1]
+
+    def site_id_rows(self):
+        '''
+        Site id of every row, -1 when off site, evaluated once per frame the first time a query needs it
+        '''
+        if self._site_ids is None:
+            self._site_ids = self.site_ids_at(self.agents, self.pos)
+        return self._site_ids
+
+    def on_site_rows(self):
+        '''
+        On-site status of every row
+        '''
+        return self.site_id_rows() >= 0
+
+    def on_site(self, agent) -> bool:
+        return self.site_id(agent) is not None
+
+    def site_id(self, agent) -> Optional[int]:
+        '''
+        agent.on_site_id() at the position the index was built with
+        '''
+        row = self._rows.get(agent.id)
+        if row is None:
+            return agent.on_site_id()
+        site_id = int(self.site_id_rows()[row])
+        return None if site_id < 0 else site_id
+
+    def counts_of(self, agents: list) -> np.ndarray:
+        '''
+        count(agent) of every agent, read from the pairs for the indexed ones; unlike count() this includes
+        neighbours killed since the last build
+        '''
+        counts = self.neighbour_counts()
+        return np.array([counts[self._rows[agent.id]] if agent.id in self._rows else len(self._neighbour_rows(agent)[0])
+                         for agent in agents], dtype=np.int64)
+
+    def of(self, agent) -> "NeighbourView":
+        '''
+        The neighbours of an agent in the current frame, built on the first query and reused until the next build
+        '''
+        view = self._views.get(agent.id)
+        if view is None:
+            view = self._views[agent.id] = NeighbourView(self, *self._neighbour_rows(agent))
+        return view
+
+    def query(self, agent, kind: Optional[type] = None, on_site: Optional[bool] = None) -> list:
+        '''
+        (agent, distance) pairs of living agents within the radius, nearest first, optionally filtered
+        by agent class and by whether they are on a site
+        '''
+        return self.of(agent).query(kind, on_site)
+
+    def count(self, agent, kind: Optional[type] = None, on_site: Optional[bool] = None) -> int:
+        return self.of(agent).count(kind, on_site)
+
+    def nearest(self, agent, kind: Optional[type] = None, on_site: Optional[bool] = None):
+        return self.of(agent).nearest(kind, on_site)
+
+    def in_proximity_accuracy(self, agent) -> ProximityIter:
+        return ProximityIter(pair for pair in self.of(agent).query())
+
+    def in_proximity_performance(self, agent) -> ProximityIter:
+        return ProximityIter(other for other, _ in self.of(agent).query())
+
+    def _neighbour_rows(self, agent):
+        row = self._rows.get(agent.id)
+        if row is not None:
+            start, end = self._indptr[row], self._indptr[row + 1]
+            return self.j[start:end], self.dist[start:end]
+
+        # spawned after the last build, so not part of the pairs yet
+        dist = np.hypot(*(self.pos - np.array(agent.pos, dtype=float)).T)
+        rows = np.nonzero(dist <= self.radius)[0]
+        rows = rows[np.argsort(dist[rows], kind="stable")]
+        return rows, dist[rows]
+
+    def _kind_code(self, cls: type) -> int:
+        if cls not in self._kinds:
+            self._kinds[cls] = len(self._kinds)
+        return self._kinds[cls]
+
+    def _codes(self, kind: type):
+        return [code for cls, code in self._kinds.items() if issubclass(cls, kind)]
+
+
+class NeighbourView:
+    '''
+    Neighbours of one agent for one frame. The (agent, distance) list of every kind/on-site filter is built
+    once, later calls only drop the neighbours that died since, as agents can be killed during the frame.
+    '''
+    __slots__ = ("index", "rows", "dist", "_pairs")
+
+    def __init__(self, index: NeighbourIndex, rows, dist):
+        self.index = index
+        self.rows = rows
+        self.dist = dist
+        self._pairs = {}  # (kind, on_site) -> (agent, distance) pairs, dead or alive
+
+    def pairs(self, kind: Optional[type] = None, on_site: Optional[bool] = None) -> list:
+        key = (kind, on_site)
+        pairs = self._pairs.get(key)
+        if pairs is None:
+            index, rows, dist = self.index, self.rows, self.dist
+            if kind is not None:
+                keep = np.isin(index.kind[rows], index._codes(kind))
+                rows, dist = rows[keep], dist[keep]
+            if on_site is not None:
+                keep = index.on_site_rows()[rows] == on_site
+                rows, dist = rows[keep], dist[keep]
+            agents = index.agents
+            pairs = self._pairs[key] = [(agents[row], d) for row, d in zip(rows.tolist(), dist.tolist())]
+        return pairs
+
+    def query(self, kind: Optional[type] = None, on_site: Optional[bool] = None) -> list:
+        return [pair for pair in self.pairs(kind, on_site) if pair[0].alive()]
+
+    def count(self, kind: Optional[type] = None, on_site: Optional[bool] = None) -> int:
+        return sum(1 for other, _ in self.pairs(kind, on_site) if other.alive())
+
+    def nearest(self, kind: Optional[type] = None, on_site: Optional[bool] = None):
+        return next((pair for pair in self.pairs(kind, on_site) if pair[0].alive()), None)
+
+
+def use_neighbour_index(simulation):
+    '''
+    Replaces the proximity engine of a simulation with a NeighbourIndex, which agents can also reach
+    through self.shared.neighbours for the filtered queries
+    '''
+    simulation._proximity = NeighbourIndex(simulation)
+    simulation.shared.neighbours = simulation._proximity
+    return simulation
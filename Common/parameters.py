@@ -0,0 +1,11 @@
+def publish_parameters(simulation):
+    '''
+    Freezes the config into its parameter block and shares it with the agents as self.shared.parameters.
+
+    The block is built once per run, after the config is final (join buffers drawn), so behaviours read plain
+    attributes instead of unpacking a tuple of the config per agent per frame. Anything that changes the config
+    while the simulation runs, like the live controls or a checkpoint restore, publishes again and the agents
+    see the new block from their next read on.
+    '''
+    simulation.shared.parameters = simulation.config.parameters()
+    return simulation
@@ -0,0 +1,127 @@
+from collections import defaultdict
+
+from pygame.sprite import Sprite
+from vi import Agent
+
+from Common.checkpoint import FRAMEWORK_ATTRIBUTES
+
+# references every agent of a simulation has, the rest of a recycled agent's attributes is reset
+KEPT_ATTRIBUTES = FRAMEWORK_ATTRIBUTES - {"_image_cache"}
+
+
+class PooledAgent(Agent):
+    '''
+    Agent whose births and deaths go through the AgentPool of its simulation when it has one.
+
+    kill() only marks the agent, it counts as dead to every query right away and leaves the groups at the
+    end of the frame. reproduce() returns the newborn right away so its move can be set, and it joins the
+    groups at the end of the frame together with the other births, in the order they were born.
+    '''
+    _dying = False
+
+    def alive(self) -> bool:
+        return not self._dying and Sprite.alive(self)
+
+    def is_alive(self) -> bool:
+        return self.alive()
+
+    def kill(self):
+        pool = getattr(self.shared, "pool", None)
+        if pool is None:
+            super().kill()
+        else:
+            pool.kill(self)
+
+    def reproduce(self):
+        pool = getattr(self.shared, "pool", None)
+        return super().reproduce() if pool is None else pool.reproduce(self)
+
+
+class AgentPool:
+    '''
+    Recycles killed agents for later births, so booms and crashes of a population reuse the same objects
+    instead of allocating a sprite per birth and leaving one to the garbage collector per death.
+
+    Agents killed in a frame are only handed out again in later frames: until the neighbour index is rebuilt
+    at the start of the next frame it still holds them and must see them dead. Up to size agents are kept
+    per class, the rest is left to the garbage collector.
+    '''
+
+    def __init__(self, simulation, size: int = 10_000):
+        self.simulation = simulation
+        self.size = size
+        self.free = defaultdict(list)  # class -> agents killed in earlier frames
+        self.born = []  # newborns of this frame, in birth order
+        self.dying = []  # agents killed this frame
+
+        self.allocated = 0
+        self.recycled = 0
+
+    def reproduce(self, parent: PooledAgent) -> PooledAgent:
+        free = self.free.get(type(parent))
+        if free:
+            child = free.pop()
+            renew(child, parent)
+            self.recycled += 1
+        else:
+            child = type(parent)(parent._images, self.simulation, parent.pos.copy(), parent.move.copy())
+            Sprite.kill(child)  # joins the groups with the other births of the frame
+            self.allocated += 1
+        self.born.append(child)
+        return child
+
+    def kill(self, agent: PooledAgent):
+        if not agent._dying:
+            agent._dying = True
+            self.dying.append(agent)
+
+    def flush(self):
+        '''
+        Applies the deaths and births of the frame to the groups and puts the dead up for recycling
+        '''
+        simulation = self.simulation
+        for agent in self.dying:
+            Sprite.kill(agent)
+        for child in self.born:
+            if not child._dying:
+                Sprite.add(child, simulation._all, simulation._agents)
+
+        for agent in self.dying:
+            free = self.free[type(agent)]
+            if len(free) < self.size:
+                free.append(agent)
+        self.born = []
+        self.dying = []
+
+
+def renew(agent: PooledAgent, parent: PooledAgent):
+    '''
+    Resets a killed agent into a newborn of parent, as if it was spawned by Agent.__copy__
+    '''
+    state = vars(agent)
+    for name in [name for name in state if name not in KEPT_ATTRIBUTES]:
+        del state[name]
+    for name, value in getattr(type(agent), "_slot_defaults", {}).items():
+        setattr(agent, name, value)
+
+    agent.id = agent._Agent__simulation._agent_id()
+    agent._image_index = 0
+    agent.move = parent.move.copy()
+    agent.on_spawn()
+    agent.pos = parent.pos.copy()
+
+
+def use_agent_pool(simulation, size: int = 10_000):
+    '''
+    Recycles the PooledAgent agents of a simulation through an AgentPool, reachable as self.shared.pool,
+    and applies their births and deaths after after_update of every frame
+    '''
+    pool = simulation.shared.pool = AgentPool(simulation, size)
+    after_update = simulation.after_update
+
+    def pooled_after_update():
+        after_update()
+        pool.flush()
+
+    simulation.after_update = pooled_after_update
+    return simulation
@@ -0,0 +1,213 @@
+import functools
+from collections import defaultdict
+from pathlib import Path
+from time import perf_counter_ns
+from typing import Optional
+
+import polars as pl
+from vi import Agent, HeadlessSimulation, Simulation
+
+# framework helpers of Agent that behaviour code calls often enough to show up in a profile
+AGENT_HELPERS = ["in_proximity_accuracy", "in_proximity_performance", "on_site", "on_site_id", "save_data",
+                 "there_is_no_escape", "reproduce", "kill"]
+
+# phases of HeadlessSimulation.tick, as (name in the profile, object attribute path)
+PHASES = [
+    ("before_update", "before_update"),
+    ("positions", "_HeadlessSimulation__update_positions"),
+    ("proximity", "_proximity.update"),
+    ("replay", "_HeadlessSimulation__collect_replay_data"),
+    ("agents", "_all.update"),
+    ("metrics", "_metrics._merge"),
+    ("after_update", "after_update"),
+]
+
+
+class Profiler:
+    '''
+    Opt-in instrumentation of a simulation: times the phases of every tick, the public methods of the
+    simulation subclass and the behaviour methods of every agent class, and keeps calls and inclusive/self
+    time per method per frame.
+
+    Methods are wrapped on the agent classes (not per agent) and on the simulation instance, and restored
+    when the run ends. With trace set, self time is also accumulated per call stack in the folded
+    "a;b;c microseconds" format read by flamegraph.pl and speedscope.
+    '''
+
+    def __init__(self, simulation: HeadlessSimulation, methods: Optional[list[str]] = None, trace: bool = False):
+        self.simulation = simulation
+        self.methods = methods
+        self.trace = trace
+
+        self._stack = []  # names of the calls in progress
+        self._children = [0]  # time spent in callees of every call in progress, the first entry is the root
+        self._calls = defaultdict(int)
+        self._total = defaultdict(int)
+        self._self = defaultdict(int)
+        self._folded = defaultdict(int)
+        self._rows = []  # (frame, name, calls, total_ns, self_ns)
+        self._patched = []  # (owner, attribute, original or None when it was not set on the owner itself)
+
+    def timed(self, name: str, function):
+        stack, children = self._stack, self._children
+        calls, total, own, folded = self._calls, self._total, self._self, self._folded
+        trace = self.trace
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stack.append(name)
+            children.append(0)
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = perf_counter_ns() - start
+                exclusive = elapsed - children.pop()
+                children[-1] += elapsed
+                calls[name] += 1
+                total[name] += elapsed
+                own[name] += exclusive
+                if trace:
+                    folded[";".join(stack)] += exclusive
+                stack.pop()
+
+        return wrapper
+
+    def patch(self, owner, attribute: str, name: str):
+        original = owner.__dict__.get(attribute) if isinstance(owner, type) else vars(owner).get(attribute)
+        self._patched.append((owner, attribute, original))
+        setattr(owner, attribute, self.timed(name, getattr(owner, attribute)))
+
+    def install(self):
+        '''
+        Wraps the phases of the simulation and the behaviour methods of every agent class in it, done on the
+        first frame because agents and metrics are usually set up after the simulation is created
+        '''
+        simulation = self.simulation
+        for name, path in PHASES:
+            *parents, attribute = path.split(".")
+            self.patch(functools.reduce(getattr, parents, simulation), attribute, name)
+        if isinstance(simulation, Simulation):
+            self.patch(simulation._all, "draw", "draw")
+
+        # interact, flock, step_bees, ...: everything public the scenario adds on top of the framework
+        framework = set(vars(Simulation)) | set(vars(HeadlessSimulation))
+        for attribute in public_methods(type(simulation), HeadlessSimulation):
+            if attribute not in framework:
+                self.patch(simulation, attribute, f"{type(simulation).__name__}.{attribute}")
+
+        for cls in {type(agent) for agent in simulation._agents}:
+            names = self.methods or public_methods(cls, Agent) + AGENT_HELPERS + ["change_position", "update"]
+            for attribute in dict.fromkeys(names):
+                if callable(getattr(cls, attribute, None)):
+                    self.patch(cls, attribute, f"{cls.__name__}.{attribute}")
+
+    def uninstall(self):
+        for owner, attribute, original in reversed(self._patched):
+            if original is None:
+                delattr(owner, attribute)
+            else:
+                setattr(owner, attribute, original)
+        self._patched = []
+
+    def end_frame(self, frame: int):
+        self._rows.extend((frame, name, calls, self._total[name], self._self[name])
+                          for name, calls in self._calls.items())
+        self._calls.clear()
+        self._total.clear()
+        self._self.clear()
+
+    @property
+    def frames(self) -> pl.DataFrame:
+        '''
+        The (frame, name, calls, total_ms, self_ms) breakdown of every frame so far
+        '''
+        return pl.DataFrame(self._rows, schema=["frame", "name", "calls", "total_ms", "self_ms"], orient="row") \
+            .with_columns(pl.col("total_ms") / 1e6, pl.col("self_ms") / 1e6)
+
+    def summary(self) -> pl.DataFrame:
+        '''
+        Calls and time per frame of every method over the whole run, the slowest first
+        '''
+        frames = self.frames
+        count = max(frames["frame"].n_unique(), 1)
+        return (
+            frames.group_by("name")
+            .agg(pl.col("calls").sum(), pl.col("total_ms").sum(), pl.col("self_ms").sum())
+            .with_columns(
+                (pl.col("calls") / count).alias("calls_per_frame"),
+                (pl.col("total_ms") / count).alias("ms_per_frame"),
+                (pl.col("self_ms") / count).alias("self_ms_per_frame"),
+            )
+            .sort("self_ms", descending=True)
+        )
+
+    def write_trace(self, path: Path):
+        '''
+        Writes the folded stacks, one "tick;agents;Bird.update;Bird.alignment <microseconds>" line per stack
+        '''
+        with open(path, "w") as f:
+            for stack, nanoseconds in sorted(self._folded.items()):
+                if nanoseconds >= 1000:
+                    f.write(f"{stack} {nanoseconds // 1000}\n")
+
+
+class ProfiledTick:
+    '''
+    Root of the profile: installs the profiler on the first tick and ends its frame after every tick
+    '''
+
+    def __init__(self, profiler: Profiler, tick):
+        self.profiler = profiler
+        self.tick = profiler.timed("tick", tick)
+        self.installed = False
+
+    def __call__(self):
+        if not self.installed:
+            self.profiler.install()
+            self.installed = True
+
+        frame = self.profiler.simulation.shared.counter
+        try:
+            self.tick()
+        finally:
+            self.profiler.end_frame(frame)
+
+
+def public_methods(cls: type, base: type) -> list[str]:
+    '''
+    Public methods defined by cls and its parents up to (not including) base
+    '''
+    return [attribute for klass in cls.__mro__[:cls.__mro__.index(base)]
+            for attribute, value in vars(klass).items()
+            if callable(value) and not isinstance(value, type) and not attribute.startswith("_")]
+
+
+def use_profiler(simulation, path: Optional[Path] = None, trace: Optional[Path] = None,
+                 methods: Optional[list[str]] = None):
+    '''
+    Profiles every frame of the simulation. When run() returns the methods are unwrapped again, the summary
+    is printed, the per-frame breakdown is written to the csv at path and the folded stacks to trace.
+    The profiler itself is kept as simulation.profiler.
+    '''
+    profiler = Profiler(simulation, methods, trace=trace is not None)
+    simulation.tick = ProfiledTick(profiler, simulation.tick)
+    simulation.profiler = profiler
+
+    run = simulation.run
+
+    def profiled_run():
+        try:
+            return run()
+        finally:
+            profiler.uninstall()
+            del simulation.run, simulation.tick
+            with pl.Config(tbl_rows=-1, tbl_width_chars=120):
+                print(profiler.summary())
+            if path is not None:
+                profiler.frames.write_csv(path)
+            if trace is not None:
+                profiler.write_trace(trace)
+
+    simulation.run = profiled_run
+    return simulation
@@ -0,0 +1,140 @@
+import dataclasses
+import os
+from multiprocessing import Pool
+from typing import Callable, Optional
+
+import numpy as np
+import polars as pl
+from vi.config import Config
+
+
+class OnlineStats:
+    '''
+    Per-frame statistics over any number of runs, merged one run at a time so no run is kept after it was added.
+
+    Mean and variance are updated with Welford's algorithm for every (keys, column). Quantiles come from a
+    histogram of at most bins (value, weight) rows per (keys, column): while a (keys, column) has seen no more
+    than bins distinct values it is exact, beyond that neighbouring values are merged into bins of equal weight
+    at their weighted mean and the quantiles are approximate: within a few bin widths, e.g. 0.1 standard
+    deviations for 1000 runs of normally distributed values with the default 100 bins.
+    A key that is missing from a run is not an observation, n counts the runs that had it.
+    '''
+
+    def __init__(self, keys: list[str], values: list[str], quantiles: tuple[float, ...] = (0.05, 0.5, 0.95),
+                 bins: int = 100):
+        self.keys = keys
+        self.values = values
+        self.quantiles = quantiles
+        self.bins = bins
+        self.runs = 0
+
+        self._moments = None  # keys, column, n, mean, m2
+        self._histogram = None  # keys, column, value, weight, at most bins rows per (keys, column)
+
+    def add(self, df: pl.DataFrame):
+        long = (
+            df.unpivot(index=self.keys, on=self.values, variable_name="column", value_name="value")
+            .drop_nulls("value")
+            .with_columns(pl.col("value").cast(pl.Float64))
+        )
+        on = self.keys + ["column"]
+
+        if self._moments is None:
+            self._moments = long.select(*on, n=pl.lit(1, pl.Int64), mean="value", m2=pl.lit(0.0))
+        else:
+            n = pl.col("n").fill_null(0) + pl.col("value").is_not_null()
+            delta = pl.col("value") - pl.col("mean").fill_null(0)
+            mean = pl.col("mean").fill_null(0) + (delta / n).fill_null(0)
+            self._moments = (
+                self._moments.join(long, on=on, how="full", coalesce=True)
+                .with_columns(n.alias("n_next"), mean.alias("mean_next"))
+                .select(
+                    *on,
+                    n=pl.col("n_next"),
+                    mean=pl.col("mean_next"),
+                    m2=pl.col("m2").fill_null(0) + (delta * (pl.col("value") - pl.col("mean_next"))).fill_null(0),
+                )
+            )
+
+        counted = long.group_by(on + ["value"]).agg(weight=pl.len().cast(pl.Int64))
+        if self._histogram is not None:
+            counted = pl.concat([self._histogram, counted]).group_by(on + ["value"]).agg(pl.col("weight").sum())
+        self._histogram = self._merge_bins(counted)
+        self.runs += 1
+
+    def _merge_bins(self, histogram: pl.DataFrame) -> pl.DataFrame:
+        '''
+        histogram with the values of every (keys, column) that has more than bins of them merged into bins of
+        equal weight, each at the weighted mean of its values
+        '''
+        on = self.keys + ["column"]
+        # the bin of a value is where the middle of its weight falls, so a heavy value keeps a bin of its own
+        middle = (pl.col("weight").cum_sum() - pl.col("weight") / 2) / pl.col("weight").sum()
+        ranked = histogram.sort(on + ["value"]).with_columns(
+            bin=pl.when(pl.len() > self.bins)
+            .then((middle * self.bins).floor().cast(pl.Int64))
+            .otherwise(pl.int_range(pl.len()))
+            .over(on)
+        )
+        return ranked.group_by(on + ["bin"]).agg(
+            value=(pl.col("value") * pl.col("weight")).sum() / pl.col("weight").sum(),
+            weight=pl.col("weight").sum(),
+        ).drop("bin")
+
+    def result(self) -> pl.DataFrame:
+        '''
+        (keys, column, n, mean, std, sem, ci_low, ci_high, q...) rows, ci is the normal 95% interval of the mean
+        '''
+        if self._moments is None:
+            return pl.DataFrame()
+
+        on = self.keys + ["column"]
+        std = (pl.col("m2") / (pl.col("n") - 1)).sqrt()
+        sem = pl.col("std") / pl.col("n").sqrt()
+        moments = self._moments.select(
+            *on, "n", "mean", std=pl.when(pl.col("n") > 1).then(std).otherwise(None),
+        ).with_columns(sem=sem).with_columns(
+            ci_low=pl.col("mean") - 1.96 * pl.col("sem"),
+            ci_high=pl.col("mean") + 1.96 * pl.col("sem"),
+        )
+
+        # the smallest value whose cumulative weight reaches q of the runs
+        histogram = self._histogram.sort(on + ["value"]).with_columns(
+            cumulative=pl.col("weight").cum_sum().over(on),
+            total=pl.col("weight").sum().over(on),
+        )
+        quantiles = [
+            histogram.filter(pl.col("cumulative") >= q * pl.col("total"))
+            .group_by(on).agg(pl.col("value").first().alias(f"q{round(q * 100):02d}"))
+            for q in self.quantiles
+        ]
+        for quantile in quantiles:
+            moments = moments.join(quantile, on=on, how="left")
+        return moments.sort(on)
+
+
+def with_seed(config: Config, seed: int) -> Config:
+    return dataclasses.replace(config, seed=seed)
+
+
+def run_replicate(args: tuple) -> pl.DataFrame:
+    # scenarios without random streams draw from the global numpy RNG, which forked workers would otherwise all share
+    run, config = args
+    np.random.seed(config.seed)
+    return run(config)
+
+
+def replicate(run: Callable[[Config], pl.DataFrame], config: Config, seeds: list[int], keys: list[str],
+              values: list[str], processes: Optional[int] = None, **options) -> OnlineStats:
+    '''
+    Runs config once per seed in a process pool and folds every run into OnlineStats as soon as it finishes.
+    run is a module-level scenario function such as Competition.run_simulation, options (quantiles, bins) go
+    to OnlineStats.
+    '''
+    stats = OnlineStats(keys, values, **options)
+    with Pool(processes or os.cpu_count()) as pool:
+        for df in pool.imap_unordered(run_replicate, [(run, with_seed(config, seed)) for seed in seeds]):
+            stats.add(df)
+            print(f"[{stats.runs}/{len(seeds)}] replicates")
+
+    return stats
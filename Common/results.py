@@ -0,0 +1,79 @@
+import json
+import os
+import uuid
+from dataclasses import asdict
+from pathlib import Path
+from typing import Optional
+
+import polars as pl
+from vi.config import Config
+
+
+class ResultStore:
+    '''
+    Partitioned parquet store for experiment outputs.
+
+    Every run is its own file under root/<table>/<key>=<value>/.../<run>.parquet, with the partition keys
+    also written as columns and the full config (including the seed) embedded as parquet metadata, so
+    appending a run never touches earlier files and scan() can read thousands of runs lazily.
+
+    Tags are partitions that are not part of the config, e.g. {"backend": "arrays"} for how a run was computed;
+    they come before the config keys in the path.
+    '''
+
+    def __init__(self, root, partition_by: list[str]):
+        self.root = Path(root)
+        self.partition_by = partition_by
+
+    def partitions(self, config: Config, tags: Optional[dict] = None) -> dict:
+        return {**(tags or {}), **{key: getattr(config, key) for key in self.partition_by}}
+
+    def path(self, table: str, config: Config, run: Optional[str] = None, tags: Optional[dict] = None) -> Path:
+        '''
+        File of a run, runs without an explicit name get one at random
+        '''
+        directory = self.root / table
+        for key, value in self.partitions(config, tags).items():
+            directory /= f"{key}={value}"
+        return directory / f"{run or uuid.uuid4().hex}.parquet"
+
+    def exists(self, table: str, config: Config, run: str, tags: Optional[dict] = None) -> bool:
+        return self.path(table, config, run, tags).exists()
+
+    def write(self, table: str, df: pl.DataFrame, config: Config, run: Optional[str] = None,
+              tags: Optional[dict] = None) -> Path:
+        '''
+        Stores the table of one run, tagged with its partition keys and config
+        '''
+        path = self.path(table, config, run, tags)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        df = df.with_columns([pl.lit(value).alias(key) for key, value in self.partitions(config, tags).items()])
+        metadata = {"config": json.dumps(asdict(config)), "seed": json.dumps(config.seed)}
+
+        # write next to the final file and move it in place, so readers never see half a run
+        partial = path.with_suffix(".partial")
+        df.write_parquet(partial, metadata=metadata)
+        os.replace(partial, path)
+        return path
+
+    def scan(self, table: str) -> pl.LazyFrame:
+        '''
+        All runs of a table as one lazy frame, filter on the partition columns before collecting
+        '''
+        return pl.scan_parquet(self.root / table / "**" / "*.parquet", hive_partitioning=False)
+
+    def configs(self, table: str) -> pl.DataFrame:
+        '''
+        The embedded config of every run in a table, read from the parquet footers only, with the tags of its
+        path as strings
+        '''
+        rows = []
+        for path in sorted((self.root / table).rglob("*.parquet")):
+            config = json.loads(pl.read_parquet_metadata(path)["config"])
+            window = config.pop("window", None) or {}
+            config.update({f"window_{key}": value for key, value in window.items()})
+            parts = (part.split("=", 1) for part in path.relative_to(self.root / table).parent.parts)
+            tags = {key: value for key, value in parts if key not in config}
+            rows.append({"path": str(path), **tags, **config})
+        return pl.DataFrame(rows)
@@ -0,0 +1,114 @@
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class Extinction:
+    '''
+    Stops once one of the named groups has no agents left, e.g. {"foxes": (1,), "rabbits": (2,)}
+    for the (agent_type,) values of the counts
+    '''
+    groups: dict[str, tuple]
+
+    def __call__(self, frame: int, counts: Counter) -> Optional[str]:
+        for name, values in self.groups.items():
+            if counts[values] == 0:
+                return f"extinction of {name}"
+        return None
+
+
+@dataclass
+class PopulationCap:
+    '''
+    Stops once more than limit agents are counted in a frame
+    '''
+    limit: int
+
+    def __call__(self, frame: int, counts: Counter) -> Optional[str]:
+        if sum(counts.values()) > self.limit:
+            return f"population above {self.limit}"
+        return None
+
+
+@dataclass
+class Stationary:
+    '''
+    Stops once the counts have stopped drifting: the mean count of every value over the older half of the last
+    window frames is within tolerance agents of the mean over the newer half
+    '''
+    window: int
+    tolerance: float = 1.0
+
+    _older: deque = field(default_factory=deque, init=False, repr=False)
+    _newer: deque = field(default_factory=deque, init=False, repr=False)
+    _older_sum: Counter = field(default_factory=Counter, init=False, repr=False)
+    _newer_sum: Counter = field(default_factory=Counter, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.window < 2:
+            raise ValueError(f"a stationary window needs at least 2 frames to compare, not {self.window}")
+
+    def __call__(self, frame: int, counts: Counter) -> Optional[str]:
+        half = self.window // 2
+
+        # slide the window by one frame, keeping the sums of both halves up to date
+        self._newer.append(counts)
+        self._newer_sum.update(counts)
+        if len(self._newer) > half:
+            moved = self._newer.popleft()
+            self._newer_sum.subtract(moved)
+            self._older.append(moved)
+            self._older_sum.update(moved)
+        if len(self._older) > half:
+            self._older_sum.subtract(self._older.popleft())
+
+        if len(self._older) < half:
+            return None
+        values = set(self._older_sum) | set(self._newer_sum)
+        if all(abs(self._older_sum[value] - self._newer_sum[value]) <= self.tolerance * half for value in values):
+            return f"stationary for {2 * half} frames"
+        return None
+
+
+class StopConditions:
+    '''
+    Evaluates the stop conditions on the counts of every frame and remembers the first one that fired
+    '''
+
+    def __init__(self, conditions: list):
+        self.conditions = conditions
+        self.reason: Optional[str] = None
+        self.frame: Optional[int] = None
+
+    def check(self, frame: int, counts: Counter) -> bool:
+        for condition in self.conditions:
+            reason = condition(frame, counts)
+            if reason is not None:
+                self.reason, self.frame = reason, frame
+                return True
+        return False
+
+    def record(self, config):
+        '''
+        Writes why and when the run ended into the stop_reason/stop_frame fields of the config, so they are
+        stored with the results like every other setting of the run
+        '''
+        config.stop_reason, config.stop_frame = self.reason, self.frame
+
+
+def use_stop_conditions(simulation, conditions: list):
+    '''
+    Ends the run of a simulation with CountingMetrics after the first frame whose counts meet one of the
+    conditions, and records the reason in its config
+    '''
+    if not conditions:
+        return simulation
+
+    def stop():
+        simulation._metrics.stopping.record(simulation.config)
+        simulation.stop()
+
+    simulation._metrics.stopping = StopConditions(conditions)
+    simulation._metrics.on_stop = stop
+    return simulation
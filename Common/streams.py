@@ -0,0 +1,83 @@
+import numpy as np
+
+# how a block of every kind of stream is drawn from its generator
+DISTRIBUTIONS = {
+    "uniform": lambda rng, size: rng.random(size),
+    "normal": lambda rng, size: rng.standard_normal(size),
+}
+
+
+class RandomStreams:
+    '''
+    Named random streams of a run, e.g. {"rabbit.roll": "uniform", "rabbit.stress": "normal"}, that give
+    every agent one number per stream per frame.
+
+    The numbers of a stream in a frame are one block drawn from a numpy Generator seeded with (seed, stream,
+    frame), indexed by agent id from the lowest id alive at the start of the frame. What an agent gets
+    depends only on the run's seed, the stream, the frame and its id: not on the order agents are
+    updated in, on how many numbers other agents used, or on which process runs it. Blocks are drawn on
+    the first use of a stream in a frame, so the per-agent and vectorized paths read the very same numbers;
+    aggregation_part2.py --check-paths verifies that both paths then count the same bees on every frame.
+    '''
+
+    def __init__(self, simulation, streams: dict[str, str]):
+        self.simulation = simulation
+        self.streams = streams
+        self.seed = np.random.SeedSequence(simulation.config.seed).entropy
+        self._keys = {name: key for key, name in enumerate(streams)}
+
+        self.frame = None
+        self.base = 0  # lowest agent id alive at the start of the frame, row 0 of every block
+        self._blocks = {}
+
+    def start_frame(self):
+        self.frame = self.simulation.shared.counter
+        self.base = min((agent.id for agent in self.simulation._agents), default=self.simulation._next_agent_id)
+        self._blocks = {}
+
+    def block(self, name: str) -> np.ndarray:
+        '''
+        The numbers of every agent id from base on, drawn again longer when agents were born since
+        '''
+        if self.frame != self.simulation.shared.counter:
+            self.start_frame()
+        block = self._blocks.get(name)
+        size = self.simulation._next_agent_id - self.base
+        if block is None or len(block) < size:
+            rng = np.random.default_rng([self.seed, self._keys[name], self.frame])
+            block = self._blocks[name] = DISTRIBUTIONS[self.streams[name]](rng, size)
+        return block
+
+    def uniform(self, name: str, id: int) -> float:
+        return float(self.block(name)[id - self.base])
+
+    def normal(self, name: str, id: int) -> float:
+        return float(self.block(name)[id - self.base])
+
+    def integers(self, name: str, id: int, low: int, high: int) -> int:
+        '''
+        An integer in [low, high) from a uniform stream
+        '''
+        return low + int(self.block(name)[id - self.base] * (high - low))
+
+    def rows(self, name: str, ids: np.ndarray) -> np.ndarray:
+        '''
+        The numbers of a stream for an array of agent ids, for the vectorized paths
+        '''
+        return self.block(name)[np.asarray(ids, dtype=np.int64) - self.base]
+
+
+def use_random_streams(simulation, streams: dict[str, str]):
+    '''
+    Gives the agents of a simulation RandomStreams as self.shared.streams, started at the beginning of every
+    frame so the lowest living id is taken before any agent is born or dies
+    '''
+    random_streams = simulation.shared.streams = RandomStreams(simulation, streams)
+    before_update = simulation.before_update
+
+    def streamed_before_update():
+        random_streams.start_frame()
+        before_update()
+
+    simulation.before_update = streamed_before_update
+    return simulation
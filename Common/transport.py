@@ -0,0 +1,135 @@
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import polars as pl
+
+# int64 slots in front of the rows: rows written, rows read, writer finished
+WRITTEN, READ, FINISHED = range(3)
+HEADER = 3
+
+# seconds a writer sleeps while its ring is full
+WAIT = 0.001
+
+
+class FrameRing:
+    '''
+    Ring buffer of int64 rows in shared memory, written by one worker process and read by its parent, e.g. the
+    (frame, site_id, count) rows of a run as every frame ends.
+
+    Columns are stored one after the other, so the unread part of a column is at most two contiguous views of
+    the shared block; read() builds its frame from those views, the only copy the rows go through. The writer
+    waits when the reader is capacity rows behind, so no row is lost. The parent creates the ring and hands
+    spec to the worker, which attaches to it.
+    '''
+
+    def __init__(self, memory: SharedMemory, columns: list[str], capacity: int):
+        self.memory = memory
+        self.columns = columns
+        self.capacity = capacity
+
+        block = np.ndarray(HEADER + len(columns) * capacity, dtype=np.int64, buffer=memory.buf)
+        self.header = block[:HEADER]
+        self.data = block[HEADER:].reshape(len(columns), capacity)
+
+    @classmethod
+    def create(cls, columns: list[str], capacity: int = 4096) -> "FrameRing":
+        memory = SharedMemory(create=True, size=8 * (HEADER + len(columns) * capacity))
+        ring = cls(memory, columns, capacity)
+        ring.header[:] = 0
+        return ring
+
+    @property
+    def spec(self) -> tuple:
+        return self.memory.name, self.columns, self.capacity
+
+    @classmethod
+    def attach(cls, spec: tuple) -> "FrameRing":
+        name, columns, capacity = spec
+        return cls(SharedMemory(name=name), columns, capacity)
+
+    def write(self, rows: np.ndarray):
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1, len(self.columns))
+        written = int(self.header[WRITTEN])
+        done = 0
+        while done < len(rows):
+            free = self.capacity - (written - int(self.header[READ]))
+            if free == 0:
+                time.sleep(WAIT)
+                continue
+
+            chunk = rows[done:done + free]
+            self.data[:, (written + np.arange(len(chunk))) % self.capacity] = chunk.T
+            written += len(chunk)
+            done += len(chunk)
+            # published after the rows themselves, so the reader never gets ahead of them
+            self.header[WRITTEN] = written
+
+    def finish(self):
+        '''
+        Marks the run as done and detaches the writer
+        '''
+        self.header[FINISHED] = 1
+        del self.header, self.data
+        self.memory.close()
+
+    @property
+    def finished(self) -> bool:
+        return bool(self.header[FINISHED])
+
+    def read(self) -> pl.DataFrame:
+        '''
+        The rows written since the last read, empty when there are none
+        '''
+        read, written = int(self.header[READ]), int(self.header[WRITTEN])
+        start, end = read % self.capacity, written % self.capacity
+        if written - read == 0:
+            parts = []
+        elif start < end:
+            parts = [slice(start, end)]
+        else:
+            parts = [slice(start, self.capacity), slice(0, end)]
+
+        df = pl.DataFrame({name: np.concatenate([column[part] for part in parts]) if parts else np.empty(0, np.int64)
+                           for name, column in zip(self.columns, self.data)})
+        self.header[READ] = written
+        return df
+
+    def release(self):
+        '''
+        Frees the shared memory, called by the parent once it read the last rows
+        '''
+        del self.header, self.data
+        self.memory.close()
+        self.memory.unlink()
+
+
+def use_frame_ring(simulation, ring: FrameRing):
+    '''
+    Writes the (frame, *values, count) rows of a simulation with CountingMetrics to ring as every frame ends,
+    and finishes the ring when run() returns. The counted values have to be ints. A run resumed from a
+    checkpoint first writes the rows it restored, so the ring always carries the whole run.
+    '''
+    after_update = simulation.after_update
+
+    def streamed_after_update():
+        after_update()
+        frame = simulation.shared.counter
+        counts = sorted(simulation._metrics.frame_counts.items())
+        ring.write([(frame, *values, count) for values, count in counts])
+
+    simulation.after_update = streamed_after_update
+
+    run = simulation.run
+
+    def streamed_run():
+        try:
+            restored = simulation._metrics.counts
+            if not restored.is_empty():
+                ring.write(restored.select(ring.columns).to_numpy())
+            return run()
+        finally:
+            ring.finish()
+
+    simulation.run = streamed_run
+    return simulation
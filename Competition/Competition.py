@@ -1,10 +1,47 @@
+import argparse
+import sys
+from pathlib import Path
+from typing import Optional
 from vi import Agent, Simulation, Window, util, HeadlessSimulation
 from vi.config import Config, dataclass, deserialize
-from numpy import random as r
+from dataclasses import dataclass as frozen_dataclass
+import numpy as np
 import polars as pl
-import seaborn as sns
 from pygame.math import Vector2
-import matplotlib.pyplot as plt
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Common.checkpoint import use_checkpoints
+from Common.control import use_control_channel
+from Common.lean import LeanAgent
+from Common.metrics import use_counting_metrics
+from Common.neighbours import use_neighbour_index
+from Common.parameters import publish_parameters
+from Common.pool import PooledAgent, use_agent_pool
+from Common.replicates import replicate
+from Common.results import ResultStore
+from Common.stopping import Extinction, PopulationCap, use_stop_conditions
+from Common.streams import use_random_streams
+from Common.transport import FrameRing, use_frame_ring
+
+# random numbers of the foxes and rabbits, one per agent per frame, see Common.streams
+STREAMS = {"fox.litter": "uniform", "rabbit.roll": "uniform", "rabbit.stress": "normal", "rabbit.litter": "uniform"}
+
+
+@frozen_dataclass(frozen=True, slots=True)
+class CompetitionParameters:
+    """
+    The settings the foxes and rabbits read every frame, frozen once per run by CompetitionConfig.parameters()
+    """
+    fox_energy: int
+    hunger: int
+    r_rep: float
+    r_rep_buffer: int
+    offspring: int
+    reach_radius: int
+    stress_deviation: float
+    t: int
+    shelter_capacity: int
+    vectorized: bool
 
 
 @deserialize
@@ -17,15 +54,53 @@ class CompetitionConfig(Config):
     offspring: int = 2  # max offspring produced at reproduction
     reach_radius: int = 15  # mating and hunting radius
     stress_deviation: float = 0.5
-    t: int = round(r.normal(30, 10))  # join buffer
+    t: Optional[int] = None  # join buffer, drawn per run from the seed when not given
     shelter_capacity: int = 15
+    vectorized: bool = False  # resolve hunting and reproduction of all agents at once in CompetitionSimulation
+    lean: bool = False  # spawn LeanFox and LeanRabbit, for populations that grow into the tens of thousands
+
+    stop_on_extinction: bool = False  # end the run once the foxes or the rabbits died out
+    population_cap: Optional[int] = None  # end the run once there are more agents than this
+    stop_reason: Optional[str] = None  # why the run ended early, set by the stop conditions
+    stop_frame: Optional[int] = None
 
-    def weights(self) -> tuple[int, int, float, int, int, int, float, int, int]:
-        return (self.fox_energy, self.hunger, self.r_rep, self.r_rep_buffer, self.offspring, self.reach_radius,
-                self.stress_deviation, self.t, self.shelter_capacity)
+    def draw_join_buffer(self):
+        """
+        Draws the join buffer t of this run from the seed, unless it was set explicitly
+        """
+        if self.t is None:
+            self.t = round(np.random.default_rng(self.seed).normal(30, 10))
+        return self
 
+    def stop_conditions(self) -> list:
+        """
+        Stop conditions on the per-frame (agent_type,) counts, fox = 1 and rabbit = 2
+        """
+        conditions = []
+        if self.stop_on_extinction:
+            conditions.append(Extinction({"foxes": (1,), "rabbits": (2,)}))
+        if self.population_cap is not None:
+            conditions.append(PopulationCap(self.population_cap))
+        return conditions
+
+    def parameters(self) -> CompetitionParameters:
+        return CompetitionParameters(
+            fox_energy=self.fox_energy, hunger=self.hunger, r_rep=self.r_rep, r_rep_buffer=self.r_rep_buffer,
+            offspring=self.offspring, reach_radius=self.reach_radius, stress_deviation=self.stress_deviation,
+            t=self.t, shelter_capacity=self.shelter_capacity, vectorized=self.vectorized,
+        )
+
+
+class Fox(PooledAgent):
+    """
+    Hunts the nearest unsheltered rabbit and mates with the nearest fox, both looked up in the neighbour index.
+
+    This differs from the original in_proximity_accuracy().first(), which took the first match in vi's engine
+    order whatever its distance and could return an agent already killed this frame. The index picks the nearest
+    match and skips dead agents, so a fox can choose a different prey or mate than it did before. Rabbits choose
+    their mates the same way.
+    """
 
-class Fox(Agent):
     energy_t: int = 0
     hunger_t: int = 0
 
@@ -44,10 +119,8 @@ class Fox(Agent):
         """
         if self.hunger_t >= hunger:
 
-            prey = (self.in_proximity_accuracy()
-                    .filter_kind(Rabbit)
-                    .filter(lambda agent: not agent[0].on_site())  # does not take sheltered rabbits into account
-                    .first())
+            # does not take sheltered rabbits into account
+            prey = self.shared.neighbours.nearest(self, kind=Rabbit, on_site=False)
 
             if prey is not None and prey[1] < reach_radius:
                 prey[0].kill()
@@ -59,12 +132,10 @@ class Fox(Agent):
         """
         Reproduction of foxes gives some probability
         """
-        mate = (self.in_proximity_accuracy()
-                .filter_kind(Fox)
-                .first())
+        mate = self.shared.neighbours.nearest(self, kind=Fox)
 
         if mate is not None and mate[1] < reach_radius:
-            for i in range(r.randint(1, offspring)):
+            for i in range(self.shared.streams.integers("fox.litter", self.id, 1, offspring)):
                 self.reproduce()
                 self.move = util.random_angle(1.5)
 
@@ -82,17 +153,18 @@ class Fox(Agent):
 
     def update(self):
         self.save_data("agent_type", 1)
+        p = self.shared.parameters
+        if p.vectorized:
+            return  # CompetitionSimulation.interact handles survival, hunting and reproduction
 
-        energy, hunger, _, _, offspring, reach_radius, _, t, _ = self.config.weights()  # init params
-
-        self.check_survival(energy)  # kill fox if no energy is left
-        self.consume(hunger, offspring, reach_radius)
+        self.check_survival(p.fox_energy)  # kill fox if no energy is left
+        self.consume(p.hunger, p.offspring, p.reach_radius)
 
         self.energy_t += 1
         self.hunger_t += 1
 
 
-class Rabbit(Agent):
+class Rabbit(PooledAgent):
     r_rep_buffer_t = 0
     t_step = 0
     state = 0  # 0=wandering, 1=joining, 2=still, 3=leaving
@@ -104,20 +176,19 @@ class Rabbit(Agent):
         Reproduction of Rabbits
         """
         if self.r_rep_buffer_t == r_rep_buffer:
-            mate = (self.in_proximity_accuracy()
-                    .filter_kind(Rabbit)
-                    .first())
+            mate = self.shared.neighbours.nearest(self, kind=Rabbit)
 
             if mate is not None and mate[1] < reach_radius:
-                roll = r.uniform()
+                streams = self.shared.streams
+                roll = streams.uniform("rabbit.roll", self.id)
 
-                if self.in_proximity_accuracy().filter_kind(Fox).count() > 0 and not self.on_site():
-                    r_bias = r.normal(0, stress_deviation)
+                if self.shared.neighbours.count(self, kind=Fox) > 0 and not self.on_site():
+                    r_bias = stress_deviation * streams.normal("rabbit.stress", self.id)
                     r_rep -= abs(r_bias)
 
                 if roll > r_rep:
                     self.r_rep_buffer_t = 0
-                    for i in range(r.randint(1, offspring)):
+                    for i in range(streams.integers("rabbit.litter", self.id, 1, offspring)):
                         self.reproduce().move = util.random_angle(1.5)  # .move = Vector2(new_x, new_y)
         else:
             self.r_rep_buffer_t += 1
@@ -137,10 +208,8 @@ class Rabbit(Agent):
             self.pos += self.move
 
     def still(self, capacity):
-        sheltered = (self.in_proximity_accuracy()
-                     .filter_kind(Rabbit)
-                     .filter(lambda agent: agent[0].on_site())  # only takes sheltered rabbits into account
-                     .count())
+        # only takes sheltered rabbits into account
+        sheltered = self.shared.neighbours.count(self, kind=Rabbit, on_site=True)
 
         if sheltered > capacity:
             self.state = 3
@@ -155,7 +224,7 @@ class Rabbit(Agent):
     def change_position(self):
 
         self.there_is_no_escape()
-        _, _, _, _, _, _, _, t, shelter_capacity = self.config.weights()  # init params
+        p = self.shared.parameters
 
         if self.state == 0:
             if self.on_site():
@@ -163,17 +232,179 @@ class Rabbit(Agent):
             else:
                 self.pos += self.move
         if self.state == 1:
-            self.join(t)
+            self.join(p.t)
         if self.state == 2:
-            self.still(shelter_capacity)
+            self.still(p.shelter_capacity)
         if self.state == 3:
             self.leave()
 
     def update(self):
         self.save_data("agent_type", 2)
+        p = self.shared.parameters
+        if p.vectorized:
+            return  # CompetitionSimulation.interact handles reproduction
+
+        self.reproduction(p.r_rep, p.r_rep_buffer, p.offspring, p.stress_deviation, p.reach_radius)
+
+
+class LeanFox(LeanAgent, Fox):
+    """
+    Fox with its state in slots and shared images, see Common.lean
+    """
+    __slots__ = ("energy_t", "hunger_t")
+
+
+class LeanRabbit(LeanAgent, Rabbit):
+    """
+    Rabbit with its state in slots and shared images, see Common.lean
+    """
+    __slots__ = ("r_rep_buffer_t", "t_step", "state")
+
+
+def match_prey(i, j, dist, hunters, prey, reach_radius, tiebreak):
+    """
+    Pairs every hunter with its nearest unclaimed prey closer than reach_radius.
+    When several hunters claim the same prey the closest one wins, ties go to the lowest tiebreak,
+    and the losers retry with their next nearest prey until no claims are left.
+    Expects the (i, j, dist) pairs grouped by i and sorted by distance, as NeighbourIndex.pairs() gives them.
+    """
+    claims = hunters[i] & prey[j] & (dist < reach_radius)
+    ci, cj, cd = i[claims], j[claims], dist[claims]
+    fed = np.zeros(len(hunters), dtype=bool)
+    eaten = np.zeros(len(hunters), dtype=bool)
+    kills = []
+
+    while len(ci):
+        nearest = np.r_[True, ci[1:] != ci[:-1]]
+        hunter, target, d = ci[nearest], cj[nearest], cd[nearest]
+
+        order = np.lexsort((tiebreak[hunter], d, target))
+        hunter, target = hunter[order], target[order]
+        won = np.r_[True, target[1:] != target[:-1]]
+        kills.append((hunter[won], target[won]))
+        fed[hunter[won]] = True
+        eaten[target[won]] = True
+
+        left = ~fed[ci] & ~eaten[cj]
+        ci, cj, cd = ci[left], cj[left], cd[left]
+
+    return fed, eaten
+
+
+def has_neighbour(i, j, dist, who, of_kind, within):
+    """
+    Mask of the rows in who that have a neighbour in of_kind closer than within
+    """
+    found = np.zeros(len(who), dtype=bool)
+    found[i[who[i] & of_kind[j] & (dist < within)]] = True
+    return found
+
+
+def interaction_rules(pairs, fox, rabbit, on_site, energy_t, hunger_t, buffer_t, p, tiebreak, draw):
+    """
+    Survival, hunting and reproduction of one frame on rows of agents, the one kernel of
+    CompetitionSimulation.interact and the array backends. energy_t, hunger_t and buffer_t are updated in place.
+    The parameters in p are scalars or one value per row, and draw(name, rows) gives the random numbers of
+    the given rows in order: standard normal for "stress", uniform in [0, 1) for "roll".
+    Returns the rows that died and the rows that reproduce.
+    """
+    i, j, dist = pairs
+    n = len(fox)
+    reach = p.reach_radius[i] if np.ndim(p.reach_radius) else p.reach_radius  # per pair when it differs per row
+
+    # foxes starve first and no longer hunt or mate in the frame they die
+    starved = fox & (energy_t == p.fox_energy)
+    fox_alive = fox & ~starved
+
+    fed, eaten = match_prey(i, j, dist, fox_alive & (hunger_t >= p.hunger), rabbit & ~on_site, reach, tiebreak)
+    energy_t[fed] = 0
+    hunger_t[fed] = 0
+    fox_parents = fed & has_neighbour(i, j, dist, fed, fox_alive, reach)
+
+    # rabbits that were eaten this frame neither mate nor count as mates
+    rabbit_alive = rabbit & ~eaten
+    ready = rabbit_alive & (buffer_t == p.r_rep_buffer)
+    buffer_t[rabbit_alive & ~ready] += 1
+
+    mated = ready & has_neighbour(i, j, dist, ready, rabbit_alive, reach)
+    stressed = mated & ~on_site & has_neighbour(i, j, dist, mated, fox_alive, np.inf)
+    threshold = np.zeros(n) + p.r_rep
+    stressed_rows = np.nonzero(stressed)[0]
+    deviation = np.broadcast_to(p.stress_deviation, (n,))[stressed_rows]
+    threshold[stressed_rows] -= np.abs(deviation * draw("stress", stressed_rows))
+    roll = np.zeros(n)
+    mated_rows = np.nonzero(mated)[0]
+    roll[mated_rows] = draw("roll", mated_rows)
+    rabbit_parents = mated & (roll > threshold)
+    buffer_t[rabbit_parents] = 0
+
+    energy_t[fox] += 1
+    hunger_t[fox] += 1
+    return starved | eaten, fox_parents | rabbit_parents
+
+
+class CompetitionSimulation(HeadlessSimulation):
+    """
+    Competition with the neighbour index, which in vectorized mode resolves survival, hunting and
+    reproduction of all foxes and rabbits in one pass at the end of every frame. Births and deaths go
+    through an agent pool that recycles killed foxes and rabbits.
+    """
+    config: CompetitionConfig
 
-        _, _, r_rep, r_rep_buffer, offspring, reach_radius, stress_deviation, _, _ = self.config.weights()  # init params
-        self.reproduction(r_rep, r_rep_buffer, offspring, stress_deviation, reach_radius)
+    def __init__(self, config: CompetitionConfig):
+        super().__init__(config)
+        use_neighbour_index(self)
+        use_agent_pool(self)
+        use_random_streams(self, STREAMS)
+
+    def after_update(self):
+        super().after_update()
+
+        if self.shared.parameters.vectorized:
+            self.interact()
+
+    def interact(self):
+        p = self.shared.parameters
+        index = self._proximity
+        agents = index.agents
+        n = len(agents)
+        if n == 0:
+            return
+
+        fox = index.kind_rows(Fox)
+        rabbit = index.kind_rows(Rabbit)
+        ids = np.array([agent.id for agent in agents])
+
+        energy_t = np.array([getattr(agent, "energy_t", 0) for agent in agents])
+        hunger_t = np.array([getattr(agent, "hunger_t", 0) for agent in agents])
+        buffer_t = np.array([getattr(agent, "r_rep_buffer_t", 0) for agent in agents])
+
+        streams = self.shared.streams
+        dead, parents = interaction_rules(index.pairs(), fox, rabbit, index.on_site_rows(), energy_t, hunger_t,
+                                          buffer_t, p, ids,
+                                          lambda name, rows: streams.rows(f"rabbit.{name}", ids[rows]))
+
+        for row in np.nonzero(fox)[0].tolist():
+            agents[row].energy_t = int(energy_t[row])
+            agents[row].hunger_t = int(hunger_t[row])
+        for row in np.nonzero(rabbit & ~dead)[0].tolist():
+            agents[row].r_rep_buffer_t = int(buffer_t[row])
+
+        for row in np.nonzero(dead)[0].tolist():
+            agents[row].kill()
+
+        parents = np.nonzero(parents)[0]
+        litter_roll = np.where(fox[parents], streams.rows("fox.litter", ids[parents]),
+                               streams.rows("rabbit.litter", ids[parents]))
+        litters = 1 + (litter_roll * (p.offspring - 1)).astype(np.int64)
+        for row, litter in zip(parents.tolist(), litters.tolist()):
+            parent = agents[row]
+            for _ in range(litter):
+                if fox[row]:
+                    parent.reproduce()
+                    parent.move = util.random_angle(1.5)
+                else:
+                    parent.reproduce().move = util.random_angle(1.5)
 
 
 energy_values = [500, 600, 700]
@@ -181,38 +412,112 @@ hunger_values = [20, 40, 60]
 # reach_values = [10, 15]
 stress_dev_values = [0.5, 0.6]
 
-energy_value = energy_values[0]
-hunger_value = hunger_values[0]
-stress_dev_value = stress_dev_values[0]
-
-df = (
-      HeadlessSimulation(
-          CompetitionConfig(
-              image_rotation=True,
-              movement_speed=1.5,
-              radius=45,
-              seed=30,
-              fps_limit=60,
-              window=Window.square(700),
-              fox_energy=energy_value,
-              hunger=hunger_value,
-              stress_deviation=stress_dev_value,
-              duration=100,
-
-              )
-          )
-      .batch_spawn_agents(100, Fox, images=["Fox.png"])
-      .batch_spawn_agents(100, Rabbit, images=["Rabbit.png"])
-      .spawn_site("site_small.png", 600, 350)
-      .run()
-      .snapshots
-      .groupby("frame")
-      .agg(
-          [
-              (pl.col('agent_type') == 1).count().alias('Foxes'),
-              (pl.col('agent_type') == 2).count().alias('Rabbits'),
-          ]
-      )
-      .sort('frame')
-)
-df.write_csv(f'comp_{energy_value}_{hunger_value}_{stress_dev_value}.csv', sep=',')
+result_keys = ["fox_energy", "hunger", "stress_deviation", "seed"]  # partitions of the stored results
+run_keys = ["duration", "stop_on_extinction"]  # partitions in front of them, runs of another length are kept apart
+
+
+def kind_counts(counts: pl.DataFrame) -> pl.DataFrame:
+    """
+    Turns the per-frame agent_type counts into one row per frame with the number of foxes and rabbits
+    """
+    return (
+        counts
+        .group_by("frame")
+        .agg(
+            [
+                pl.col("count").filter(pl.col('agent_type') == 1).sum().alias('Foxes'),
+                pl.col("count").filter(pl.col('agent_type') == 2).sum().alias('Rabbits'),
+            ]
+        )
+        .sort('frame')
+    )
+
+
+def populate(simulation, foxes: int = 100, rabbits: int = 100, counts_path: Optional[Path] = None):
+    simulation.config.draw_join_buffer()
+    publish_parameters(simulation)
+    use_counting_metrics(simulation, ["agent_type"], path=counts_path)
+    fox, rabbit = (LeanFox, LeanRabbit) if simulation.config.lean else (Fox, Rabbit)
+    return (
+        use_stop_conditions(simulation, simulation.config.stop_conditions())
+        .batch_spawn_agents(foxes, fox, images=["Fox.png"])
+        .batch_spawn_agents(rabbits, rabbit, images=["Rabbit.png"])
+        .spawn_site("site_small.png", 600, 350)
+    )
+
+
+def run_simulation(config: CompetitionConfig, checkpoint: Optional[Path] = None, every: int = 1000,
+                   control: Optional[int] = None, frames: Optional[FrameRing] = None,
+                   counts_path: Optional[Path] = None) -> Optional[pl.DataFrame]:
+    """
+    Runs one headless competition and returns the number of foxes and rabbits per frame. With a checkpoint path
+    the run is saved there every `every` frames and continues from it when it already exists. With a control
+    port its parameters can be changed and its counts followed over a loopback control channel while it runs.
+    With a FrameRing the (frame, agent_type, count) rows are written to it as the run goes and nothing is
+    returned, see kind_counts for the table they make. With a counts_path those rows go to that csv every 1000
+    frames instead of staying in memory, and are read back once the run ends.
+    """
+    simulation = populate(CompetitionSimulation(config), counts_path=counts_path)
+    if control is not None:
+        use_control_channel(simulation, control)
+    if frames is not None:
+        use_frame_ring(simulation, frames)
+    if checkpoint is not None:
+        use_checkpoints(simulation, checkpoint, every)
+    if frames is not None:
+        simulation.run()
+        return None
+    return kind_counts(simulation.run().counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs one headless Fox/Rabbit competition and stores the counts")
+    parser.add_argument("--energy", type=int, default=energy_values[0])
+    parser.add_argument("--hunger", type=int, default=hunger_values[0])
+    parser.add_argument("--stress", type=float, default=stress_dev_values[0])
+    parser.add_argument("--seed", type=int, default=30)
+    parser.add_argument("--duration", type=int, default=100)
+    parser.add_argument("--out", type=Path, default=Path("results"))
+    parser.add_argument("--replicates", type=int, default=1, help="run this many seeds from --seed on")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--stop-early", action="store_true", help="end the run once a species died out")
+    parser.add_argument("--checkpoint", type=Path, default=None,
+                        help="save the run here every 1000 frames and continue from it if it exists")
+    parser.add_argument("--lean", action="store_true", help="memory-lean agents for very large populations")
+    parser.add_argument("--control", type=int, default=None, metavar="PORT",
+                        help="serve a loopback control channel on this port (0 for any free one)")
+    parser.add_argument("--counts", type=Path, default=None,
+                        help="write the counts to this csv as the run goes instead of keeping them in memory")
+    args = parser.parse_args()
+
+    config = CompetitionConfig(
+        image_rotation=True,
+        movement_speed=1.5,
+        radius=45,
+        seed=args.seed,
+        fps_limit=60,
+        window=Window.square(700),
+        fox_energy=args.energy,
+        hunger=args.hunger,
+        stress_deviation=args.stress,
+        duration=args.duration,
+        stop_on_extinction=args.stop_early,
+        lean=args.lean,
+    )
+    if args.replicates > 1:
+        # mean, spread and quantiles of the counts per frame over the seeds, stored without a seed partition
+        seeds = list(range(args.seed, args.seed + args.replicates))
+        stats = replicate(run_simulation, config, seeds, ["frame"], ["Foxes", "Rabbits"], args.processes)
+        store = ResultStore(args.out, result_keys[:-1])
+        print(store.write("competition_replicates", stats.result(), config, run=f"seeds-{seeds[0]}-{seeds[-1]}"))
+        return
+
+    store = ResultStore(args.out, run_keys + result_keys)
+    counts = run_simulation(config, args.checkpoint, control=args.control, counts_path=args.counts)
+    print(store.write("competition", counts, config, tags={"backend": "sprites"}))
+    if args.checkpoint is not None:
+        args.checkpoint.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import itertools
+import os
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+from vi import Window
+
+from Competition import CompetitionConfig
+from Common.results import ResultStore
+from sweep import BACKENDS
+
+TABLE = "competition_adaptive"
+
+# the explored parameters with their (low, high) bounds, ints stay ints
+SPACE = {
+    "fox_energy": (300, 900),
+    "hunger": (10, 80),
+    "stress_deviation": (0.2, 1.0),
+    "r_rep": (0.5, 1.0),
+    "reach_radius": (8, 25),
+    "shelter_capacity": (5, 30),
+}
+
+# (length scale, noise) pairs the surrogate picks from by marginal likelihood, on the unit cube
+LENGTH_SCALES = (0.15, 0.25, 0.4, 0.6, 1.0)
+NOISES = (1e-3, 1e-2, 0.1, 0.3)
+
+
+def latin_hypercube(n: int, dims: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    n points in the unit cube with exactly one point in each of the n slices of every dimension
+    """
+    slices = np.stack([rng.permutation(n) for _ in range(dims)], axis=1)
+    return (slices + rng.random((n, dims))) / n
+
+
+def to_settings(unit: np.ndarray) -> dict:
+    """
+    The parameter values of a point of the unit cube
+    """
+    settings = {}
+    for (name, (low, high)), u in zip(SPACE.items(), unit):
+        value = low + u * (high - low)
+        settings[name] = int(round(value)) if isinstance(low, int) else round(float(value), 3)
+    return settings
+
+
+def to_unit(settings: dict) -> np.ndarray:
+    return np.array([(settings[name] - low) / (high - low) for name, (low, high) in SPACE.items()])
+
+
+def point_config(settings: dict, seed: int, duration: int) -> CompetitionConfig:
+    return CompetitionConfig(
+        image_rotation=True,
+        movement_speed=1.5,
+        radius=45,
+        seed=seed,
+        window=Window.square(700),
+        duration=duration,
+        stop_on_extinction=True,
+        **settings,
+    )
+
+
+def run_name(settings: dict) -> str:
+    return "-".join(f"{name}={value}" for name, value in settings.items())
+
+
+def outcomes(counts: pl.DataFrame, duration: int) -> tuple[float, float]:
+    """
+    (coexistence, log ratio) of a run: the share of the duration both species survived, and the log of the
+    rabbits per fox on the last frame (plus one each, so an extinction stays finite)
+    """
+    last = counts.sort("frame").row(-1, named=True)
+    coexistence = min((last["frame"] + 1) / duration, 1.0)
+    return coexistence, float(np.log((last["Rabbits"] + 1) / (last["Foxes"] + 1)))
+
+
+def run_point(settings: dict, seed: int, duration: int, store: ResultStore, backend: str) -> tuple:
+    """
+    Runs one point of the design, stores its per-frame counts and returns its outcomes
+    """
+    config = point_config(settings, seed, duration)
+    counts = BACKENDS[backend](config)
+    store.write(TABLE, counts, config, run=run_name(settings), tags={"backend": backend})
+    return settings, outcomes(counts, duration)
+
+
+def _run_point(args: tuple) -> tuple:
+    return run_point(*args)
+
+
+def observed(store: ResultStore, duration: int, backend: str) -> list[tuple]:
+    """
+    (settings, outcomes) of every point already in the store with the same duration and backend, so an
+    interrupted exploration continues
+    """
+    if not (store.root / TABLE).exists():
+        return []
+    points = []
+    runs = store.configs(TABLE).filter((pl.col("duration") == duration) & (pl.col("backend") == backend))
+    for config in runs.iter_rows(named=True):
+        settings = {name: config[name] for name in SPACE}
+        points.append((settings, outcomes(pl.read_parquet(config["path"]), duration)))
+    return points
+
+
+class GaussianProcess:
+    """
+    Gaussian process regression with a squared exponential kernel on the unit cube, in plain numpy.
+
+    Targets are standardized, the length scale and noise are the pair of LENGTH_SCALES x NOISES with the
+    highest marginal likelihood; the noise takes up the spread between seeds of runs with the same settings.
+    """
+
+    def __init__(self, x: np.ndarray, y: np.ndarray):
+        self.x = x
+        self.shift, self.scale = y.mean(), y.std() or 1.0
+        z = (y - self.shift) / self.scale
+        self.length, self.noise = max(itertools.product(LENGTH_SCALES, NOISES),
+                                      key=lambda pair: self.likelihood(z, *pair))
+        self.factor = np.linalg.cholesky(self.kernel(x, x, self.length) + self.noise * np.eye(len(x)))
+        self.alpha = np.linalg.solve(self.factor.T, np.linalg.solve(self.factor, z))
+
+    @staticmethod
+    def kernel(a: np.ndarray, b: np.ndarray, length: float) -> np.ndarray:
+        distance = ((a[:, np.newaxis, :] - b[np.newaxis, :, :]) ** 2).sum(axis=2)
+        return np.exp(-0.5 * distance / length ** 2)
+
+    def likelihood(self, z: np.ndarray, length: float, noise: float) -> float:
+        try:
+            factor = np.linalg.cholesky(self.kernel(self.x, self.x, length) + noise * np.eye(len(self.x)))
+        except np.linalg.LinAlgError:
+            return -np.inf
+        alpha = np.linalg.solve(factor.T, np.linalg.solve(factor, z))
+        return -0.5 * z @ alpha - np.log(np.diag(factor)).sum()
+
+    def predict(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Mean and standard deviation of the prediction at every row of x
+        """
+        cross = self.kernel(x, self.x, self.length)
+        v = np.linalg.solve(self.factor, cross.T)
+        variance = np.clip(1.0 - (v ** 2).sum(axis=0), 0.0, None)
+        return self.shift + self.scale * (cross @ self.alpha), self.scale * np.sqrt(variance)
+
+    def posterior_std(self, x: np.ndarray, pending: np.ndarray) -> np.ndarray:
+        """
+        Standard deviation at x once the pending points are observed as well. It does not depend on what they
+        will turn out to be, so a batch can be picked before any of its runs finished.
+        """
+        known = np.concatenate([self.x, pending])
+        factor = np.linalg.cholesky(self.kernel(known, known, self.length) + self.noise * np.eye(len(known)))
+        v = np.linalg.solve(factor, self.kernel(x, known, self.length).T)
+        return self.scale * np.sqrt(np.clip(1.0 - (v ** 2).sum(axis=0), 0.0, None))
+
+
+def next_batch(points: list[tuple], size: int, rng: np.random.Generator, candidates: int = 2000,
+               boundary: float = 0.5) -> list[dict]:
+    """
+    The size settings to run next: greedily the candidate where the coexistence is most uncertain near its
+    boundary (the straddle 1.96 * std - |mean - boundary|), counting the points picked before it as observed
+    """
+    x = np.array([to_unit(settings) for settings, _ in points])
+    surrogate = GaussianProcess(x, np.array([coexistence for _, (coexistence, _) in points]))
+
+    options = np.array([to_unit(to_settings(u)) for u in latin_hypercube(candidates, len(SPACE), rng)])
+    mean, _ = surrogate.predict(options)
+    batch = []
+    for _ in range(size):
+        std = surrogate.posterior_std(options, np.array(batch).reshape(-1, len(SPACE)))
+        batch.append(options[np.argmax(1.96 * std - np.abs(mean - boundary))])
+    return [to_settings(u) for u in batch]
+
+
+def explore(budget: int, initial: int, duration: int, store: ResultStore, seed: int = 30,
+            processes: int = None, backend: str = "sprites") -> pl.DataFrame:
+    """
+    Maps where foxes and rabbits coexist with budget runs: a latin hypercube of initial runs, then batches
+    picked by next_batch from a surrogate refitted after every batch, each batch run in parallel.
+
+    Every run is stored when it finishes and the points in the store are reused, so a killed exploration
+    continues where it stopped. Returns the surrogate's coexistence and log ratio prediction on a fresh
+    latin hypercube of the space.
+    """
+    rng = np.random.default_rng(seed)
+    processes = processes or os.cpu_count()
+    points = observed(store, duration, backend)
+    print(f"{len(points)} runs done, {max(budget - len(points), 0)} to go")
+
+    done = {run_name(settings) for settings, _ in points}
+    design = [to_settings(u) for u in latin_hypercube(initial, len(SPACE), rng)]
+
+    # spawned, not forked: observed() already ran polars here, and a fork would inherit its locked thread pool
+    with get_context("spawn").Pool(processes) as pool:
+        while len(points) < budget:
+            if len(points) < initial:
+                batch = [settings for settings in design if run_name(settings) not in done][:budget - len(points)]
+            else:
+                batch = next_batch(points, min(processes, budget - len(points)), rng)
+
+            jobs = [(settings, seed + len(points) + i, duration, store, backend) for i, settings in enumerate(batch)]
+            for settings, result in pool.imap_unordered(_run_point, jobs):
+                points.append((settings, result))
+                print(f"[{len(points)}/{budget}] {settings} coexistence {result[0]:.2f} log ratio {result[1]:.2f}")
+
+    x = np.array([to_unit(settings) for settings, _ in points])
+    grid = np.array([to_unit(to_settings(u)) for u in latin_hypercube(2000, len(SPACE), rng)])
+    predicted = {name: [to_settings(u)[name] for u in grid] for name in SPACE}
+    for i, outcome in enumerate(["coexistence", "log_ratio"]):
+        mean, std = GaussianProcess(x, np.array([result[i] for _, result in points])).predict(grid)
+        predicted |= {outcome: mean, f"{outcome}_std": std}
+    return pl.DataFrame(predicted)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adaptively maps the fox/rabbit coexistence region of the "
+                                                 "Competition parameter space with a surrogate model")
+    parser.add_argument("--budget", type=int, default=120, help="total number of simulation runs")
+    parser.add_argument("--initial", type=int, default=4 * len(SPACE), help="runs of the space-filling design")
+    parser.add_argument("--duration", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=30)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--out", type=Path, default=Path("results"))
+    parser.add_argument("--backend", choices=BACKENDS, default="sprites")
+    args = parser.parse_args()
+
+    predicted = explore(args.budget, args.initial, args.duration, ResultStore(args.out, ["seed"]), args.seed,
+                        args.processes, args.backend)
+    predicted.write_parquet(args.out / f"{TABLE}_surrogate.parquet")
+    share = (predicted["coexistence"] >= 0.99).mean()
+    print(f"surrogate predicts coexistence over the whole run in {share:.0%} of the space")
@@ -0,0 +1,201 @@
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import polars as pl
+
+from Competition import CompetitionConfig, interaction_rules
+from Common.checkpoint import read_checkpoint, write_checkpoint
+from Common.neighbours import neighbour_pairs
+from Common.stopping import StopConditions
+
+FOX = 0
+RABBIT = 1
+
+# how ArrayCompetition.draw makes the numbers of each name from a generator and the parameters of the rows
+DRAWS = {
+    "stress": lambda rng, p, size: rng.standard_normal(size),
+    "roll": lambda rng, p, size: rng.uniform(size=size),
+    "litter": lambda rng, p, size: rng.integers(1, p.offspring, size=size, endpoint=False),
+    "angle": lambda rng, p, size: rng.uniform(0, 2 * np.pi, size=size),
+}
+
+
+class ArrayCompetition:
+    """
+    Pure-numpy headless backend of the competition: every agent is a row in a set of arrays, no pygame
+    sprites, images or masks are involved.
+
+    Sites are circles (the site images are filled discs), so on_site is a distance check against
+    site radius + agent_radius instead of a mask collision, and wrapping around the window is a modulo.
+    The behaviour follows Fox/Rabbit.change_position and CompetitionSimulation.interact frame by frame.
+    """
+
+    def __init__(self, config: CompetitionConfig, foxes: int = 100, rabbits: int = 100,
+                 sites: tuple = ((600, 350, 50),), agent_radius: float = 7):
+        self.config = config.draw_join_buffer()
+        self.parameters = config.parameters()  # rebuilt by whoever changes config mid-run
+        self.rng = np.random.default_rng(config.seed)
+        self.size = np.array(config.window.as_tuple(), dtype=float)
+        self.sites = np.array(sites, dtype=float).reshape(-1, 3)
+        self.agent_radius = agent_radius
+        self.frame = 0  # next frame to run
+        self.rows = []  # (frame, foxes, rabbits) of the frames run so far
+        self.stopping = StopConditions(self.config.stop_conditions())
+
+        n = foxes + rabbits
+        self.kind = np.r_[np.full(foxes, FOX), np.full(rabbits, RABBIT)]
+        self.pos = self.rng.uniform(0, 1, size=(n, 2)) * self.size
+        self.move = self.random_moves(n, config.movement_speed)
+        self.energy_t = np.zeros(n, dtype=np.int64)
+        self.hunger_t = np.zeros(n, dtype=np.int64)
+        self.buffer_t = np.zeros(n, dtype=np.int64)
+        self.state = np.zeros(n, dtype=np.int64)  # 0=wandering, 1=joining, 2=still, 3=leaving
+        self.t_step = np.zeros(n, dtype=np.int64)
+
+        # neighbour pairs of the last frame, the rabbits' shelter check runs before they are rebuilt
+        self.pairs = neighbour_pairs(self.pos, config.radius)
+        self.on_site = self.site_check()
+
+    def random_moves(self, n: int, length: float):
+        angle = self.rng.uniform(0, 2 * np.pi, size=n)
+        return length * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+
+    def site_check(self):
+        if len(self.sites) == 0:
+            return np.zeros(len(self.pos), dtype=bool)
+        delta = self.pos[:, np.newaxis, :] - self.sites[np.newaxis, :, :2]
+        return (np.hypot(delta[..., 0], delta[..., 1]) <= self.sites[:, 2] + self.agent_radius).any(axis=1)
+
+    def change_positions(self):
+        p = self.parameters
+        self.pos %= self.size
+        on_site = self.site_check()
+        fox = self.kind == FOX
+        rabbit = ~fox
+
+        # foxes turn around and step out of shelters
+        bounce = fox & on_site
+        self.move[bounce] *= -1
+        self.pos[bounce] += 4 * self.move[bounce]
+        moves = fox.astype(np.int64)
+
+        # rabbits, in the order of Rabbit.change_position
+        state, t_step = self.state, self.t_step
+        wandering = rabbit & (state == 0)
+        moves[wandering & ~on_site] += 1
+        state[wandering & on_site] = 1
+
+        joining = rabbit & (state == 1)
+        t_step[joining] += 1
+        joined = joining & (t_step == p.t)
+        t_step[joined] = 0
+        state[joined] = np.where(on_site[joined], 2, 0)
+        moves[joining & ~joined] += 1
+
+        i, j, _ = self.pairs
+        still = rabbit & (state == 2)
+        sheltered = np.bincount(i[(self.kind[j] == RABBIT) & self.on_site[j]], minlength=len(state))
+        state[still & (sheltered > p.shelter_capacity)] = 3
+
+        leaving = rabbit & (state == 3)
+        state[leaving & ~on_site] = 0
+        moves[leaving & on_site] += 1
+
+        self.pos += moves[:, np.newaxis] * self.move
+
+    def draw(self, name: str, rows: np.ndarray) -> np.ndarray:
+        """
+        The random numbers of the given rows in order, made by DRAWS[name]: "stress" and "roll" for
+        interaction_rules, "litter" sizes and birth "angle"s
+        """
+        return DRAWS[name](self.rng, self.parameters, len(rows))
+
+    def interact(self):
+        fox = self.kind == FOX
+        dead, parents = interaction_rules(self.pairs, fox, ~fox, self.on_site, self.energy_t, self.hunger_t,
+                                          self.buffer_t, self.parameters, np.arange(len(self.pos)), self.draw)
+
+        parents = np.nonzero(parents)[0]
+        born = np.repeat(parents, self.draw("litter", parents).astype(np.int64))
+        angle = self.draw("angle", born)
+        born_move = 1.5 * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+
+        # a fox parent turns to a new random direction after every birth and the cub keeps the old one
+        fox_born = fox[born]
+        if fox_born.any():
+            first = np.r_[True, born[1:] != born[:-1]]
+            previous = np.r_[0, np.arange(len(born) - 1)]
+            cub_move = np.where(first[:, np.newaxis], self.move[born], born_move[previous])
+            last = np.r_[born[1:] != born[:-1], True]
+            self.move[born[fox_born & last]] = born_move[fox_born & last]
+            born_move[fox_born] = cub_move[fox_born]
+
+        self.append(born, born_move, ~dead)
+
+    def append(self, parents, moves, keep):
+        """
+        Removes the rows that died and adds a fresh row for every birth, copying the parent's kind and position
+        """
+        count = len(parents)
+        self.kind = np.r_[self.kind[keep], self.kind[parents]]
+        self.pos = np.r_[self.pos[keep], self.pos[parents]]
+        self.move = np.r_[self.move[keep], moves]
+        self.on_site = np.r_[self.on_site[keep], self.on_site[parents]]
+        for name in ("energy_t", "hunger_t", "buffer_t", "state", "t_step"):
+            setattr(self, name, np.r_[getattr(self, name)[keep], np.zeros(count, dtype=np.int64)])
+
+        i, j, dist = self.pairs
+        rows = np.cumsum(keep) - 1
+        alive = keep[i] & keep[j]
+        self.pairs = rows[i[alive]], rows[j[alive]], dist[alive]
+
+    def step(self) -> tuple[int, int]:
+        """
+        One frame: move, rebuild the neighbour pairs, count, then interact. Returns the counts of the frame.
+        """
+        self.change_positions()
+        self.pairs = neighbour_pairs(self.pos, self.config.radius)
+        self.on_site = self.site_check()
+        counts = int((self.kind == FOX).sum()), int((self.kind == RABBIT).sum())
+        self.interact()
+        return counts
+
+    def run(self, checkpoint: Optional[Path] = None, every: int = 1000) -> pl.DataFrame:
+        """
+        Runs frames up to duration, like HeadlessSimulation.run, and returns the foxes and rabbits per frame.
+        Stops early on the stop conditions of the config, which see the counts as (agent_type,) like CountingMetrics.
+        With a checkpoint path the whole state is written there every `every` frames, see resume().
+        """
+        while self.frame <= self.config.duration:
+            foxes, rabbits = self.step()
+            self.rows.append((self.frame, foxes, rabbits))
+            if self.stopping.check(self.frame, Counter({(FOX + 1,): foxes, (RABBIT + 1,): rabbits})):
+                self.stopping.record(self.config)
+                break
+
+            self.frame += 1
+            if checkpoint is not None and self.frame % every == 0:
+                write_checkpoint(checkpoint, vars(self))
+
+        return pl.DataFrame(self.rows, schema=["frame", "Foxes", "Rabbits"], orient="row")
+
+    @classmethod
+    def resume(cls, checkpoint: Path) -> "ArrayCompetition":
+        """
+        The simulation as it was written to checkpoint, run() continues it with the frame after
+        """
+        simulation = cls.__new__(cls)
+        vars(simulation).update(read_checkpoint(checkpoint))
+        return simulation
+
+
+def run_array_simulation(config: CompetitionConfig, checkpoint: Optional[Path] = None,
+                         every: int = 1000) -> pl.DataFrame:
+    """
+    Array counterpart of Competition.run_simulation
+    """
+    if checkpoint is not None and Path(checkpoint).exists():
+        return ArrayCompetition.resume(checkpoint).run(checkpoint, every)
+    return ArrayCompetition(config).run(checkpoint, every)
@@ -0,0 +1,133 @@
+from collections import Counter
+from types import SimpleNamespace
+
+import numpy as np
+import polars as pl
+
+from Competition import CompetitionConfig
+from Common.neighbours import neighbour_pairs
+from array_simulation import DRAWS, FOX, RABBIT, ArrayCompetition
+
+# per-row arrays of ArrayCompetition, reordered together when rows are added or removed
+ROW_ARRAYS = ("kind", "pos", "move", "on_site", "energy_t", "hunger_t", "buffer_t", "state", "t_step", "world")
+
+# settings every world of a batch has to share, they shape the arrays and the neighbour grid
+SHARED_SETTINGS = ("radius", "window", "movement_speed")
+
+
+class BatchedCompetition(ArrayCompetition):
+    """
+    Steps many independent competitions ("worlds") together in one set of ArrayCompetition arrays, so a
+    single process runs a batch of seeds or parameter points with one numpy call per kernel per frame
+    instead of one per world.
+
+    Every row has a world id. Rows are kept grouped by world, the world is part of the neighbour grid's cell
+    key so no pair crosses worlds, and the parameters are looked up per row from the world's block. Each world
+    keeps the random generator, stop conditions and counts of its own ArrayCompetition and draws the same
+    numbers in the same order, so a world of a batch runs exactly like ArrayCompetition(config).run().
+    A world that stopped or reached its duration is dropped from the arrays.
+    """
+
+    def __init__(self, configs: list[CompetitionConfig], foxes: int = 100, rabbits: int = 100,
+                 sites: tuple = ((600, 350, 50),), agent_radius: float = 7):
+        for name in SHARED_SETTINGS:
+            if len({repr(getattr(config, name)) for config in configs}) > 1:
+                raise ValueError(f"the worlds of a batch have to share their {name}")
+
+        worlds = [ArrayCompetition(config, foxes, rabbits, sites, agent_radius) for config in configs]
+        for world, simulation in enumerate(worlds):
+            simulation.world = np.full(len(simulation.pos), world)
+        for name in ROW_ARRAYS:
+            setattr(self, name, np.concatenate([getattr(simulation, name) for simulation in worlds]))
+
+        self.configs = configs
+        self.config = configs[0]  # for the shared settings
+        self.rngs = [simulation.rng for simulation in worlds]
+        self.stoppings = [simulation.stopping for simulation in worlds]
+        self.world_rows = [simulation.rows for simulation in worlds]
+        self.active = list(range(len(worlds)))
+        self.blocks = {name: np.array([getattr(simulation.parameters, name) for simulation in worlds])
+                       for name in worlds[0].parameters.__slots__}
+        self.world_parameters = [simulation.parameters for simulation in worlds]
+
+        self.size = worlds[0].size
+        self.sites = worlds[0].sites
+        self.agent_radius = agent_radius
+        self.frame = 0
+        self.pairs = neighbour_pairs(self.pos, self.config.radius, self.world)
+        self.parameters = self.row_parameters()
+
+    def row_parameters(self) -> SimpleNamespace:
+        """
+        The parameter block of every row's world, as arrays the kernels of ArrayCompetition broadcast over
+        """
+        return SimpleNamespace(**{name: values[self.world] for name, values in self.blocks.items()})
+
+    def draw(self, name: str, rows: np.ndarray) -> np.ndarray:
+        """
+        ArrayCompetition.draw for rows grouped by world: the numbers of every active world's rows come from its
+        own generator with its own parameters, also when it has no rows, so it advances as in ArrayCompetition
+        """
+        counts = np.bincount(self.world[rows], minlength=len(self.configs))
+        return np.concatenate([DRAWS[name](self.rngs[w], self.world_parameters[w], counts[w]) for w in self.active])
+
+    def append(self, parents, moves, keep):
+        """
+        ArrayCompetition.append, after which the newborns are moved behind the survivors of their own world
+        """
+        world = np.r_[self.world[keep], self.world[parents]]
+        super().append(parents, moves, keep)
+        self.world = world
+        self.reorder(np.argsort(world, kind="stable"))
+
+    def reorder(self, order: np.ndarray):
+        for name in ROW_ARRAYS:
+            setattr(self, name, getattr(self, name)[order])
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        i, j, dist = self.pairs
+        self.pairs = position[i], position[j], dist
+
+    def step(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        One frame of every active world. Returns the foxes and rabbits per world.
+        """
+        self.parameters = self.row_parameters()
+        self.change_positions()
+        self.pairs = neighbour_pairs(self.pos, self.config.radius, self.world)
+        self.on_site = self.site_check()
+        fox = self.kind == FOX
+        counts = (np.bincount(self.world[fox], minlength=len(self.configs)),
+                  np.bincount(self.world[~fox], minlength=len(self.configs)))
+        self.interact()
+        return counts
+
+    def run(self) -> list[pl.DataFrame]:
+        """
+        Runs every world up to its duration or stop condition, returns the foxes and rabbits per frame of each
+        """
+        while self.active:
+            foxes, rabbits = self.step()
+            finished = []
+            for w in self.active:
+                self.world_rows[w].append((self.frame, int(foxes[w]), int(rabbits[w])))
+                counts = Counter({(FOX + 1,): int(foxes[w]), (RABBIT + 1,): int(rabbits[w])})
+                if self.stoppings[w].check(self.frame, counts):
+                    self.stoppings[w].record(self.configs[w])
+                    finished.append(w)
+                elif self.frame >= self.configs[w].duration:
+                    finished.append(w)
+
+            self.frame += 1
+            if finished:
+                self.active = [w for w in self.active if w not in finished]
+                self.append(np.empty(0, dtype=np.int64), np.empty((0, 2)), ~np.isin(self.world, finished))
+
+        return [pl.DataFrame(rows, schema=["frame", "Foxes", "Rabbits"], orient="row") for rows in self.world_rows]
+
+
+def run_batched_simulations(configs: list[CompetitionConfig]) -> list[pl.DataFrame]:
+    """
+    The counts of run_array_simulation for every config, computed in one BatchedCompetition
+    """
+    return BatchedCompetition(configs).run()
@@ -0,0 +1,122 @@
+import argparse
+import itertools
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import polars as pl
+from vi import Window
+
+from Competition import (CompetitionConfig, energy_values, hunger_values, result_keys, run_keys, run_simulation,
+                         stress_dev_values)
+from Common.results import ResultStore
+from array_simulation import run_array_simulation
+from batched_simulation import run_batched_simulations
+
+KEYS = result_keys
+TABLE = "competition"
+RUN = "counts"
+BACKENDS = {"sprites": run_simulation, "arrays": run_array_simulation}
+
+
+def grid(seeds: list[int]) -> list[tuple]:
+    """
+    Every (fox_energy, hunger, stress_deviation, seed) cell of the sweep
+    """
+    return list(itertools.product(energy_values, hunger_values, stress_dev_values, seeds))
+
+
+def cell_config(cell: tuple, duration: int, stop_early: bool = False) -> CompetitionConfig:
+    energy, hunger, stress_deviation, seed = cell
+    return CompetitionConfig(
+        image_rotation=True,
+        movement_speed=1.5,
+        radius=45,
+        seed=seed,
+        window=Window.square(700),
+        fox_energy=energy,
+        hunger=hunger,
+        stress_deviation=stress_deviation,
+        duration=duration,
+        stop_on_extinction=stop_early,
+    )
+
+
+def run_cell(cell: tuple, duration: int, store: ResultStore, backend: str = "sprites",
+             stop_early: bool = False) -> tuple:
+    """
+    Runs one cell of the grid and stores its per-frame counts as its own partition of the result table
+    """
+    config = cell_config(cell, duration, stop_early)
+    store.write(TABLE, BACKENDS[backend](config), config, run=RUN, tags={"backend": backend})
+    return cell
+
+
+def run_batch(cells: list[tuple], duration: int, store: ResultStore, stop_early: bool = False) -> list[tuple]:
+    """
+    Runs cells together in one BatchedCompetition and stores each like run_cell does with the arrays backend,
+    whose counts the batch reproduces exactly
+    """
+    configs = [cell_config(cell, duration, stop_early) for cell in cells]
+    for config, counts in zip(configs, run_batched_simulations(configs)):
+        store.write(TABLE, counts, config, run=RUN, tags={"backend": "arrays"})
+    return cells
+
+
+def sweep(seeds: list[int], duration: int, store: ResultStore, processes: int = None,
+          backend: str = "sprites", stop_early: bool = False, batch: int = 1) -> pl.DataFrame:
+    """
+    Runs every cell of the grid that is not in the result store yet, in a process pool sized to the machine.
+
+    Each cell is written atomically when it finishes, so a killed sweep resumes from the cells that were
+    completed. The store is partitioned by run_keys + KEYS and tagged with the backend, so only a run with the
+    same backend, duration and stop setting counts as done. With stop_early a cell ends once the foxes or
+    rabbits died out, the stop_reason and stop_frame of its stored config say when. With the arrays backend
+    and a batch above 1 every process steps that many cells at once in one BatchedCompetition.
+    """
+    tags = {"backend": backend}
+    todo = [cell for cell in grid(seeds) if not store.exists(TABLE, cell_config(cell, duration, stop_early), RUN, tags)]
+    print(f"{len(grid(seeds)) - len(todo)} cells done, {len(todo)} to go")
+
+    if backend == "arrays" and batch > 1:
+        jobs = [(todo[start:start + batch], duration, store, stop_early) for start in range(0, len(todo), batch)]
+        run = _run_batch
+    else:
+        jobs = [([cell], duration, store, backend, stop_early) for cell in todo]
+        run = _run_cell
+
+    finished = 0
+    with Pool(processes or os.cpu_count()) as pool:
+        for cells in pool.imap_unordered(run, jobs):
+            for cell in cells:
+                finished += 1
+                print(f"[{finished}/{len(todo)}] {dict(zip(KEYS, cell))}")
+
+    runs = store.scan(TABLE).filter((pl.col("backend") == backend) & (pl.col("duration") == duration)
+                                    & (pl.col("stop_on_extinction") == stop_early))
+    return runs.collect().sort(KEYS + ["frame"])
+
+
+def _run_cell(args: tuple) -> list[tuple]:
+    cells, *rest = args
+    return [run_cell(cells[0], *rest)]
+
+
+def _run_batch(args: tuple) -> list[tuple]:
+    return run_batch(*args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the full Competition parameter grid over multiple seeds")
+    parser.add_argument("--seeds", type=int, nargs="+", default=[30, 31, 32, 33, 34])
+    parser.add_argument("--duration", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--out", type=Path, default=Path("results"))
+    parser.add_argument("--backend", choices=BACKENDS, default="sprites")
+    parser.add_argument("--stop-early", action="store_true", help="end a cell once the foxes or rabbits died out")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="cells stepped together per process in one array engine, arrays backend only")
+    args = parser.parse_args()
+
+    sweep(args.seeds, args.duration, ResultStore(args.out, run_keys + KEYS), args.processes, args.backend,
+          args.stop_early, args.batch)
@@ -1,13 +1,41 @@
+import argparse
+import sys
 from enum import Enum, auto
+from pathlib import Path
+from typing import Optional
 import pygame as pg
 import vi
 from pygame.math import Vector2
-from vi import Agent, Simulation
+from vi import Agent, HeadlessSimulation, Simulation
 from vi.config import Config, dataclass, deserialize
+from dataclasses import dataclass as frozen_dataclass, replace
 
 import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Common.control import use_control_channel
+from Common.lean import LeanAgent
+from Common.neighbours import use_neighbour_index
+from Common.parameters import publish_parameters
+from Common.profiling import use_profiler
+
 MAX_VEL = 2
 
+IMAGE = Path(__file__).resolve().parent / "green.png"  # the bird image, found wherever the script is started from
+
+
+
+@frozen_dataclass(frozen=True, slots=True)
+class FlockingParameters:
+    '''
+    The settings the birds read every frame, frozen by FlockingConfig.parameters()
+    '''
+    alignment_weight: float
+    cohesion_weight: float
+    separation_weight: float
+    delta_time: float
+    mass: int
+    vectorized: bool
 
 
 @deserialize
@@ -21,12 +49,44 @@ class FlockingConfig(Config):
 
     mass: int = 20
 
-    def weights(self) -> tuple[float, float, float]:
-        return (self.alignment_weight, self.cohesion_weight, self.separation_weight)
+    vectorized: bool = False  # compute the steering of all birds in one numpy pass instead of per bird
+
+    def parameters(self) -> FlockingParameters:
+        return FlockingParameters(
+            alignment_weight=self.alignment_weight, cohesion_weight=self.cohesion_weight,
+            separation_weight=self.separation_weight, delta_time=self.delta_time, mass=self.mass,
+            vectorized=self.vectorized,
+        )
+
+
+def normalize(vectors):
+    '''
+    Scales every row to unit length, rows of length zero stay zero
+    '''
+    length = np.hypot(vectors[:, 0], vectors[:, 1])[:, np.newaxis]
+    return np.divide(vectors, length, out=np.zeros_like(vectors), where=length > 0)
+
+
+def steering(pos, move, i, j, dist):
+    '''
+    Alignment, cohesion and seperation of every boid in one pass, mirrors the per-bird methods of Bird
+    '''
+    n = len(pos)
+    scalar = 1 / (np.bincount(i, minlength=n) + 1)[:, np.newaxis]
+
+    def neighbour_sum(values):
+        return np.stack([np.bincount(i, weights=values[:, 0], minlength=n),
+                         np.bincount(i, weights=values[:, 1], minlength=n)], axis=1)
+
+    alignment = normalize(scalar * (move + neighbour_sum(move[j])) * MAX_VEL) - move
+    cohesion = normalize(scalar * (move + neighbour_sum(pos[j])) * MAX_VEL) - pos
+    seperation = normalize(scalar * (pos + neighbour_sum((pos[i] - pos[j]) / dist[:, np.newaxis])) * MAX_VEL)
+    return alignment, cohesion, seperation
 
 
 class Bird(Agent):
     config: FlockingConfig
+    steering = None  # combined steering force, applied to the move in the next change_position
 
     def alignment(self, neighbours):
         '''
@@ -76,17 +136,41 @@ class Bird(Agent):
             new_pos = Vector2(new_pos[0], new_pos[1]).normalize()
             return new_pos
 
+    def update(self):
+        p = self.shared.parameters
+        if p.vectorized:
+            return  # FlockingLive computes the steering of all birds at once
+
+        neighbours = self.in_proximity_accuracy().count()
+        if neighbours == 0:
+            self.steering = None
+            return
+
+        self.steering = (p.alignment_weight * self.alignment(neighbours)
+                         + p.cohesion_weight * self.cohesion(neighbours)
+                         + p.separation_weight * self.seperation(neighbours))
+
     def change_position(self):
-        global MAX_VEL
         # Pac-man-style teleport to the other end of the screen when trying to escape
         self.there_is_no_escape()
-        self.pos += self.move
-        in_proximity = self.in_proximity_accuracy().count()
+
+        p = self.shared.parameters
+        if self.steering is not None:
+            self.move += self.steering / p.mass
+            if self.move.length() > MAX_VEL:
+                self.move.scale_to_length(MAX_VEL)
+
+        self.pos += self.move * p.delta_time
         if self.on_site():
             self.kill()
-        self.p
 
 
+class LeanBird(LeanAgent, Bird):
+    '''
+    Bird drawn from the shared rotation atlas instead of rotating its own image every drawn frame
+    '''
+    __slots__ = ("steering", "neighbours")
+
 
 class Selection(Enum):
     ALIGNMENT = auto()
@@ -94,8 +178,84 @@ class Selection(Enum):
     SEPARATION = auto()
 
 
-class FlockingLive(Simulation):
+class FlockingSimulation(HeadlessSimulation):
+    '''
+    Flocking with the neighbour index, which in vectorized mode steers all birds at the end of every frame
+    '''
+    config: FlockingConfig
+
+    def __init__(self, config: FlockingConfig):
+        super().__init__(config)
+        use_neighbour_index(self)
+        publish_parameters(self)
+
+    def after_update(self):
+        if self.shared.parameters.vectorized:
+            self.flock()
+
+        super().after_update()
+
+    def flock(self):
+        '''
+        Vectorized counterpart of Bird.update: steers every bird using one set of position/velocity arrays
+        '''
+        index = self._proximity
+        birds = index.agents
+        if not birds:
+            return
+
+        move = np.array([bird.move for bird in birds], dtype=float)
+
+        i, j, dist = index.pairs()
+        alignment, cohesion, seperation = steering(index.pos, move, i, j, dist)
+
+        p = self.shared.parameters
+        force = p.alignment_weight * alignment + p.cohesion_weight * cohesion + p.separation_weight * seperation
+        has_neighbours = np.bincount(i, minlength=len(birds)) > 0
+
+        for bird, (x, y), steer in zip(birds, force, has_neighbours):
+            bird.steering = Vector2(x, y) if steer else None
+
+
+class Hud(pg.sprite.Sprite):
+    '''
+    Weights, selection and simulation steps per drawn frame in the top left corner of FlockingLive. Drawn
+    with the agents, and rendered again only when one of them changed.
+    '''
+
+    def __init__(self, simulation: "FlockingLive"):
+        super().__init__(simulation._all)
+        self.simulation = simulation
+        self.font = pg.font.Font(None, 24)
+        self.shown = None
+        self.update()
+
+    def update(self):
+        simulation = self.simulation
+        p = simulation.shared.parameters
+        shown = (p.alignment_weight, p.cohesion_weight, p.separation_weight, simulation.selection,
+                 simulation.steps_per_frame)
+        if shown == self.shown:
+            return
+
+        self.shown = shown
+        weights = zip(Selection, "ACS", shown[:3])
+        text = "  ".join(f"{'>' if selection == simulation.selection else ' '}{name}: {weight:.1f}"
+                         for selection, name, weight in weights)
+        self.image = self.font.render(f"{text}   steps/frame: {simulation.steps_per_frame}", True, (255, 255, 255))
+        self.rect = self.image.get_rect(topleft=(8, 8))
+
+
+class FlockingLive(FlockingSimulation, Simulation):
+    '''
+    Interactive flocking: 1/2/3 select a weight, up/down change it and left/right change how many simulation
+    steps run per drawn frame. Events are handled and the screen is drawn only on drawn frames, the steps in
+    between run headless.
+    '''
     selection: Selection = Selection.COHESION
+    steps_per_frame: int = 1
+    drawing: bool = True
+    hud: Optional[Hud] = None
     config: FlockingConfig
 
     def handle_event(self, by: float):
@@ -105,9 +265,19 @@ class FlockingLive(Simulation):
             self.config.cohesion_weight += by
         elif self.selection == Selection.SEPARATION:
             self.config.separation_weight += by
+        publish_parameters(self)
 
     def before_update(self):
+        self.drawing = self.shared.counter % self.steps_per_frame == 0
+        if not self.drawing:
+            HeadlessSimulation.before_update(self)
+            return
+
         super().before_update()
+        if self.hud is None:
+            # created on the first drawn frame, after the birds were spawned, so it is drawn on top of them
+            pg.font.init()
+            self.hud = Hud(self)
 
         for event in pg.event.get():
             if event.type == pg.KEYDOWN:
@@ -115,6 +285,10 @@ class FlockingLive(Simulation):
                     self.handle_event(by=1.0)
                 elif event.key == pg.K_DOWN:
                     self.handle_event(by=-1.0)
+                elif event.key == pg.K_RIGHT:
+                    self.steps_per_frame += 1
+                elif event.key == pg.K_LEFT:
+                    self.steps_per_frame = max(self.steps_per_frame - 1, 1)
                 elif event.key == pg.K_1:
                     self.selection = Selection.ALIGNMENT
                 elif event.key == pg.K_2:
@@ -122,23 +296,82 @@ class FlockingLive(Simulation):
                 elif event.key == pg.K_3:
                     self.selection = Selection.SEPARATION
 
-        a, c, s = self.config.weights()
-        print(f"A: {a:.1f} - C: {c:.1f} - S: {s:.1f}")
+    def after_update(self):
+        if self.drawing:
+            super().after_update()
+            return
+
+        # FlockingSimulation.after_update without the drawing of Simulation
+        if self.shared.parameters.vectorized:
+            self.flock()
+        HeadlessSimulation.after_update(self)
+
+
+def positions(config: FlockingConfig, birds: int, frames: int) -> np.ndarray:
+    '''
+    The position of every bird, in id order, after each of frames headless frames
+    '''
+    simulation = FlockingSimulation(config).batch_spawn_agents(birds, Bird, images=[str(IMAGE)])
+    rows = []
+    for _ in range(frames):
+        simulation.tick()
+        rows.append([bird.pos for bird in sorted(simulation._agents, key=lambda bird: bird.id)])
+    return np.array(rows, dtype=float)
 
 
-(
-    FlockingLive(
-        FlockingConfig(
-            image_rotation=True,
-            movement_speed=1.0,
-            radius=35,
-            seed=24,
-            fps_limit =100,
+def first_divergence(config: FlockingConfig, birds: int = 300, frames: int = 500,
+                     tolerance: float = 1e-9) -> Optional[int]:
+    '''
+    Runs config from the same seed with the per-bird steering of Bird and the vectorized steering(), returns the
+    first frame where a bird is more than tolerance apart between the two, None when they agree on every frame
+    '''
+    per_bird, vectorized = (positions(replace(config, vectorized=flag), birds, frames) for flag in (False, True))
+    apart = np.nonzero((np.abs(per_bird - vectorized) > tolerance).any(axis=(1, 2)))[0]
+    return int(apart[0]) if len(apart) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Live flocking, tune the weights with 1/2/3 and up/down, "
+                                                 "the simulation steps per drawn frame with left/right")
+    parser.add_argument("--birds", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=24)
+    parser.add_argument("--radius", type=int, default=35)
+    parser.add_argument("--per-agent", action="store_true", help="use the per-bird reference steering")
+    parser.add_argument("--steps", type=int, default=1, help="simulation steps per drawn frame")
+    parser.add_argument("--profile", type=Path, default=None,
+                        help="profile the run, writes <profile>.csv per frame and <profile>.folded stacks")
+    parser.add_argument("--control", type=int, default=None, metavar="PORT",
+                        help="serve a loopback control channel on this port (0 for any free one)")
+    parser.add_argument("--check-paths", type=int, default=None, metavar="FRAMES",
+                        help="run this many frames headless per bird and vectorized and report where they diverge")
+    args = parser.parse_args()
+
+    if args.check_paths is not None:
+        config = FlockingConfig(image_rotation=True, movement_speed=1.0, radius=args.radius, seed=args.seed)
+        frame = first_divergence(config, args.birds, args.check_paths)
+        print("per-bird and vectorized positions match" if frame is None else f"paths diverge from frame {frame}")
+        sys.exit(frame is not None)
+
+    simulation = (
+        FlockingLive(
+            FlockingConfig(
+                image_rotation=True,
+                movement_speed=1.0,
+                radius=args.radius,
+                seed=args.seed,
+                fps_limit=100,
+                vectorized=not args.per_agent,
+            )
         )
+        .batch_spawn_agents(args.birds, LeanBird, images=[str(IMAGE)])
     )
+    simulation.steps_per_frame = args.steps
+    if args.profile is not None:
+        use_profiler(simulation, args.profile.with_suffix(".csv"), args.profile.with_suffix(".folded"))
+    if args.control is not None:
+        use_control_channel(simulation, args.control)
+    simulation.run()
+
 
-        .batch_spawn_agents(1000, Bird, images=["green.png",
-                                              "red.png",
-                                              "bird.png"])
-        .run()
-)
+if __name__ == "__main__":
+    main()